@@ -1,32 +1,53 @@
-from datetime import datetime
-from sys import getsizeof
-
-from flask import Flask, Response, redirect, url_for, flash, session
+from flask import Response, redirect, url_for, flash, session, request, abort, render_template, jsonify, \
+    stream_with_context, make_response, current_app
 from flask_login import login_user, logout_user, login_required, current_user
-from flask_migrate import Migrate
-from flask_toastr import Toastr
+from werkzeug.exceptions import RequestEntityTooLarge
 
+from book_cafe.activity_tracker import record_activity
+from book_cafe.app_factory import create_app
 from book_cafe.app_logger import logger
-from book_cafe.db_functions import query_books, initialize_database
-from book_cafe.db_objects import Role, Role_User, User, Book, db
+from book_cafe.catalogue_io import export_records, to_csv, to_ndjson, buffered, gzipped, parse_book_batch, \
+    EXPORT_MIMETYPES, EDITABLE_FIELDS
+from book_cafe.cover_processing import cover_processor, read_upload
+from book_cafe.cover_store import send_cover
+from book_cafe.db_functions import cached_query_book_page, decode_page_cursor, apply_book_batch
+from book_cafe.db_objects import Role, Role_User, User, Book, Author_Stats, db
 from book_cafe.email_functions import send_email
-from book_cafe.exceptions import sql_alchemy_exception
-from book_cafe.forms import Login_Form, Register_Form, Add_Book_Form, Find_Book_Form
-from book_cafe.navbar import render_template_navbar, navbar_news_stream, set_navbar_news
-from book_cafe.redis import redis_client
-from book_cafe.user_management import role_required, refresh_user, login_manager
-from confidential import SECRET_KEY, EMAIL_ADDRESS_ADMIN
-from configuration import DB_CONNECTION_STRING, MAX_FAILED_LOGIN_ATTEMPTS, DEBUG_MODE_ON, HOST_IP
+from book_cafe.exceptions import sql_alchemy_exception, Hashing_Service_Busy, Cover_Processing_Busy
+from book_cafe.forms import Login_Form, Register_Form, Add_Book_Form, Find_Book_Form, Bulk_Book_Form
+from book_cafe.login_throttle import is_login_throttled, record_failed_login, clear_failed_logins
+from book_cafe.navbar import render_template_navbar, set_navbar_news
+from book_cafe.page_cache import listing_validators, listing_not_modified, not_modified_response, add_validators
+from book_cafe.search_cache import search_cache
+from book_cafe.suggestions import get_suggestions
+from book_cafe.user_management import role_required, refresh_user
+from confidential import EMAIL_ADDRESS_ADMIN
+from configuration import DEBUG_MODE_ON, HOST_IP, COVER_THUMBNAIL_SIZES, COVER_MAX_UPLOAD_BYTES, SUGGEST_MIN_PREFIX_LENGTH, \
+    SUGGEST_LIMIT, AUTHOR_PAGE_SIZE, COVER_MAX_REQUEST_BYTES
+
+app = create_app(__name__)
+
+
+@app.errorhandler(Hashing_Service_Busy)
+def hashing_service_busy(e: Hashing_Service_Busy) -> Response:
+    logger.info("Password hashing service busy.")
+    flash("Server busy, please try again.")
+    return redirect(request.path)
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = DB_CONNECTION_STRING
-app.config["SECRET_KEY"] = SECRET_KEY
-db.init_app(app)
-migrate = Migrate(app, db)
-redis_client.init_app(app)
-toastr = Toastr(app)
 
-app.register_blueprint(navbar_news_stream)
+@app.errorhandler(Cover_Processing_Busy)
+def cover_processing_busy(e: Cover_Processing_Busy) -> Response:
+    logger.info("Cover processing busy.")
+    flash("Server busy, please try again.")
+    return redirect(request.path)
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_entity_too_large(e: RequestEntityTooLarge) -> Response:
+    if request.path.startswith("/api/"):
+        return make_response(jsonify({"error": "Request body too large."}), 413)
+    flash("Cover picture size is too large." if request.endpoint == "add_book" else "Request too large.")
+    return redirect(request.path)
 
 
 @app.route('/register', methods=["GET", "POST"])
@@ -47,7 +68,7 @@ def register():
         db.session.commit()
         flash("New account created.")
         logger.info(f"Account for user {username} created.")
-        send_email('new registration', f'{username} just registered.', [EMAIL_ADDRESS_ADMIN, ])
+        send_email('new registration', f'{username} just registered.', [EMAIL_ADDRESS_ADMIN, ], digest=True)
         return redirect(url_for("login"))
     return render_template_navbar("sign_up.html", form=form)
 
@@ -59,25 +80,30 @@ def login():
     if form.validate_on_submit():
         username = form.username.data
         password = form.password.data
+        ip = request.remote_addr
+        if is_login_throttled(username, ip):
+            flash("Too many failed login attempts")
+            return render_template_navbar("login.html", form=form)
         user = User.get_user_by_name(username=username)
         if not user:
+            record_failed_login(None, ip)
             flash("Register first")
             return redirect(url_for("register"))
-        elif user.failed_login_attempts > MAX_FAILED_LOGIN_ATTEMPTS:
-            flash("Too many failed login attempts")
         elif user.check_password(password):
+            if user.password_needs_rehash():
+                user.set_password(password)
             login_user(user)
-            user.is_logged_in = True
+            user.set_logged_in(True)
             db.session.commit()
+            record_activity(user.id, force=True)
+            clear_failed_logins(username)
             flash("You are logged in.")
-            logger.info(f"User {username} logged in.")
+            logger.info(f"User {username} logged in.", extra={"high_volume": True})
             set_navbar_news(f'{username} logged in.')
             return redirect(url_for("find_book"))
         else:
-            user.failed_login_attempts += 1
-            user.last_failed_login_attempt = datetime.now()
-            db.session.commit()
-            logger.info(f"Unsuccessful login attempt for user {username}.")
+            record_failed_login(username, ip)
+            logger.info(f"Unsuccessful login attempt for user {username}.", extra={"high_volume": True})
     return render_template_navbar("login.html", form=form)
 
 
@@ -85,9 +111,9 @@ def login():
 @login_required
 @sql_alchemy_exception()
 def logout() -> Response:
-    logger.info(f'{current_user.username} logged out.')
+    logger.info(f'{current_user.username} logged out.', extra={'high_volume': True})
     set_navbar_news(f'{current_user.username} logged out.')
-    current_user.is_logged_in = False
+    User.get_user_by_id(current_user.id).set_logged_in(False)
     db.session.commit()
     logout_user()
     session.clear()
@@ -108,51 +134,131 @@ def home() -> Response:
 @role_required("Admin")
 @refresh_user()
 def add_book():
+    request.max_content_length = COVER_MAX_REQUEST_BYTES
     form = Add_Book_Form()
     if form.validate_on_submit():
         existing_book = Book.get_books_by_author_title(form.author.data, form.title.data)
         if existing_book:
             flash("Book already in library.")
             return render_template_navbar("add_book.html", form=form)
-        binary_pic_data = None
+        cover_data = None
         if form.cover_picture.data:
-            binary_pic_data = form.cover_picture.data.read()
-            if getsizeof(binary_pic_data) > 500 * 1024:
+            cover_data = read_upload(form.cover_picture.data, COVER_MAX_UPLOAD_BYTES)
+            if cover_data is None:
                 flash("Cover picture size is too large.")
                 return render_template_navbar("add_book.html", form=form)
-        Book.add_new(
-            title=form.title.data,
-            author=form.author.data,
-            description=form.description.data,
-            user_id=current_user.id,
-            cover_picture=binary_pic_data)
-        db.session.commit()
+        if cover_data:
+            cover_processor.reserve()
+        try:
+            new_book = Book.add_new(
+                title=form.title.data,
+                author=form.author.data,
+                description=form.description.data,
+                user_id=current_user.id,
+                cover_hash=None)
+            book_id = new_book.id
+            db.session.commit()
+        except BaseException:
+            if cover_data: cover_processor.release()
+            raise
+        if cover_data:
+            cover_processor.submit(current_app._get_current_object(), book_id, cover_data)
         flash("Book added to library.")
         logger.info(f"Book \'{form.title.data}\' added to library.")
         return redirect(url_for("add_book"))
     return render_template_navbar("add_book.html", form=form)
 
 
-@app.route("/delete_book/<id>", methods=["GET", "POST"])
+@app.route("/delete_book/<int:id>", methods=["POST"])
 @login_required
 @sql_alchemy_exception()
 @role_required("Admin")
 @refresh_user()
 def delete_book(id: int) -> Response:
-    book = Book.get_book_by_id(id)
-    book.delete()
-    db.session.commit()
-    flash("Book deleted from library.")
-    logger.info(f"Book \'{book.title}\' deleted.")
+    if not Bulk_Book_Form(prefix="bulk").validate_on_submit():
+        abort(400)
+    result = apply_book_batch([id], [])
+    if result is None:
+        flash("Deleting the book failed.")
+    elif result['deleted']:
+        flash("Book deleted from library.")
+    else:
+        flash("Book not found.")
+    return redirect(url_for("find_book"))
+
+
+@app.route("/books/bulk", methods=["POST"])
+@login_required
+@sql_alchemy_exception()
+@role_required("Admin")
+@refresh_user()
+def bulk_books() -> Response:
+    form = Bulk_Book_Form(prefix="bulk")
+    if not form.validate_on_submit():
+        abort(400)
+    book_ids = request.form.getlist("book_ids", type=int)
+    if not book_ids:
+        flash("No books selected.")
+        return redirect(url_for("find_book"))
+    values = {f: form[f].data for f in EDITABLE_FIELDS if form[f].data}
+    try:
+        if form.delete.data:
+            batch = parse_book_batch({"delete": book_ids})
+        else:
+            batch = parse_book_batch({"update": [dict(values, id=book_id) for book_id in book_ids]})
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for("find_book"))
+    result = apply_book_batch(*batch)
+    if result is None:
+        flash("The changes could not be saved, nothing was changed.")
+    elif form.delete.data:
+        flash(f"{result['deleted']} books deleted from library.")
+    else:
+        flash(f"{result['updated']} books updated.")
     return redirect(url_for("find_book"))
 
 
+@app.route("/api/books/batch", methods=["POST"])
+@login_required
+@sql_alchemy_exception()
+@role_required("Admin")
+def api_books_batch() -> Response:
+    if not request.is_json:
+        abort(415)
+    try:
+        batch = parse_book_batch(request.get_json(silent=True))
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    result = apply_book_batch(*batch)
+    if result is None:
+        return make_response(jsonify({"error": "The batch could not be applied, nothing was changed."}), 409)
+    return jsonify(result)
+
+
+@app.route("/cover/<int:book_id>")
+@sql_alchemy_exception()
+def cover(book_id: int) -> Response:
+    size = request.args.get("size")
+    if size and size not in COVER_THUMBNAIL_SIZES:
+        abort(404)
+    cover_hash = Book.get_cover_hash(book_id)
+    response = send_cover(cover_hash, size) if cover_hash else None
+    if not response:
+        abort(404)
+    return response
+
+
 @app.route("/find_book", methods=["GET", "POST"])
 @login_required
 @sql_alchemy_exception()
 @refresh_user()
 def find_book():
     form = Find_Book_Form()
+    if "author" in request.args:
+        session['author'] = request.args["author"]
+        session['title'] = ""
+        return redirect(url_for("find_book"))
     if form.validate_on_submit():
         title = form.title.data
         author = form.author.data
@@ -164,14 +270,83 @@ def find_book():
     form.title.data = session.get("title") or ""
     form.author.data = session.get("author") or ""
     form.sort_by.data = session.get("sort_by") or "title"
-    books = query_books(form.author.data, form.title.data, form.sort_by.data)
-    return render_template_navbar("find_book.html", books=books, form=form)
+    etag, modified = listing_validators(form.author.data, form.title.data, form.sort_by.data)
+    if listing_not_modified(etag):
+        return not_modified_response(etag, modified)
+    books, next_cursor = cached_query_book_page(form.author.data, form.title.data, form.sort_by.data)
+    response = make_response(render_template_navbar("find_book.html", books=books, next_cursor=next_cursor, form=form,
+                                                    bulk_form=Bulk_Book_Form(prefix="bulk", formdata=None)))
+    return add_validators(response, etag, modified)
+
+
+@app.route("/find_book/page")
+@login_required
+@sql_alchemy_exception()
+@refresh_user()
+def find_book_page():
+    query = (session.get("author") or "", session.get("title") or "", session.get("sort_by") or "title",
+             request.args.get("cursor"))
+    etag, modified = listing_validators(*query)
+    if listing_not_modified(etag):
+        return not_modified_response(etag, modified)
+    try:
+        books, next_cursor = cached_query_book_page(*query)
+    except ValueError:
+        abort(400)
+    return add_validators(make_response(render_template("book_cards.html", books=books, next_cursor=next_cursor)),
+                          etag, modified)
+
+
+@app.route("/authors")
+@login_required
+@sql_alchemy_exception()
+@refresh_user()
+def authors():
+    start = request.args.get("start", "")
+    rows = Author_Stats.get_page(start=start, limit=AUTHOR_PAGE_SIZE + 1) or []
+    next_start = rows[AUTHOR_PAGE_SIZE].author if len(rows) > AUTHOR_PAGE_SIZE else None
+    return render_template_navbar("authors.html", authors=rows[:AUTHOR_PAGE_SIZE], start=start, next_start=next_start)
+
+
+@app.route("/suggest")
+@login_required
+def suggest() -> Response:
+    prefix = request.args.get("q", "").strip()
+    suggestions = get_suggestions(prefix, SUGGEST_LIMIT) if len(prefix) >= SUGGEST_MIN_PREFIX_LENGTH else None
+    response = jsonify(suggestions or {"title": [], "author": []})
+    response.cache_control.private = True
+    response.cache_control.max_age = 60
+    return response
+
+
+@app.route("/api/books")
+@login_required
+@sql_alchemy_exception()
+def api_books() -> Response:
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_MIMETYPES:
+        abort(400)
+    try:
+        after = decode_page_cursor(request.args["after"]) if request.args.get("after") else None
+    except ValueError:
+        abort(400)
+    records = export_records(request.args.get("author", ""), request.args.get("title", ""),
+                             request.args.get("sort_by", "title"), after)
+    chunks = buffered(to_csv(records) if export_format == "csv" else to_ndjson(records))
+    headers = {"Vary": "Accept-Encoding"}
+    if request.accept_encodings["gzip"]:
+        chunks = gzipped(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[export_format], headers=headers)
+
+
+@app.route("/search_cache_stats")
+@login_required
+@role_required("Admin")
+def search_cache_stats() -> Response:
+    return jsonify(search_cache.stats())
 
 
 if __name__ == "__main__":
     logger.info(f"-------- app started --------")
-    with app.app_context():
-        db.create_all()
-        initialize_database()
-        login_manager.init_app(app)
     app.run(debug=DEBUG_MODE_ON, host=HOST_IP, threaded=True)
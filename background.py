@@ -1,38 +1,48 @@
-import time
 from datetime import datetime, timedelta
+from typing import Callable
 
-from flask import Flask
-
+from book_cafe.activity_tracker import get_unflushed_activity, mark_activity_flushed, get_active_user_ids
+from book_cafe.app_factory import create_app
 from book_cafe.app_logger import logger
 from book_cafe.db_objects import db
+from book_cafe.email_functions import deliver_emails
 from book_cafe.exceptions import sql_alchemy_exception, reddis_exception
+from book_cafe.navbar import clear_navbar_news
 from book_cafe.redis import redis_client
+from book_cafe.scheduler import Job, Scheduler
 from book_cafe.user_management import User
-from confidential import SECRET_KEY
-from configuration import CYCLIC_TASKS_FREQUENCY_SECONDS, DB_CONNECTION_STRING, DEBUG_MODE_ON
+from configuration import CYCLIC_TASKS_FREQUENCY_SECONDS, AUTOMATIC_LOGOUT_INACTIVITY_MINUTES, \
+    BACKGROUND_JOB_INTERVAL_SECONDS, BACKGROUND_JOB_CHUNK_SIZE
 from constants import DATE_TIME_FORMAT, REDIS_KEY_NAVBAR_NEWS, REDIS_KEY_NAVBAR_NEWS_DATE
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = DB_CONNECTION_STRING
-app.config["SECRET_KEY"] = SECRET_KEY
-redis_client.init_app(app)
-db.init_app(app)
+app = create_app(__name__)
 
 
 @sql_alchemy_exception()
-def reset_failed_login_attempts(db_session):
-    users = User.get_users_with_failed_logins_to_reset()
-    for u in users: u.reset_failed_login_attempts()
+def flush_user_activity(db_session) -> int:
+    unflushed = get_unflushed_activity()
+    if not unflushed: return 0
+    activities, flush_started = unflushed
+    User.update_last_activities(activities)
     db_session.commit()
+    inactive_threshold = datetime.now() - timedelta(minutes=AUTOMATIC_LOGOUT_INACTIVITY_MINUTES)
+    mark_activity_flushed(flush_started, prune_before=inactive_threshold)
+    return len(activities)
 
 
 @sql_alchemy_exception()
-def logout_inactive_users(db_session):
-    users = User.get_inactive_users()
-    for u in users:
-        u.is_logged_in = False
-        logger.info(f"user {u.username} logged out because of inactivity.")
-    db_session.commit()
+def logout_inactive_users(db_session) -> int:
+    inactive_threshold = datetime.now() - timedelta(minutes=AUTOMATIC_LOGOUT_INACTIVITY_MINUTES)
+    active_user_ids = get_active_user_ids(since=inactive_threshold)
+    if active_user_ids is None: return 0
+    logged_out = 0
+    while (rows := User.logout_inactive_users_chunk(BACKGROUND_JOB_CHUNK_SIZE, active_user_ids)) is not None:
+        db_session.commit()
+        logged_out += len(rows)
+        if rows:
+            logger.info(f"{len(rows)} users logged out because of inactivity: {', '.join(r.username for r in rows)}.")
+        if len(rows) < BACKGROUND_JOB_CHUNK_SIZE: break
+    return logged_out
 
 
 @reddis_exception()
@@ -41,19 +51,21 @@ def clean_navbar_news():
     if not news_age_redis: return
     news_age = datetime.strptime(news_age_redis, DATE_TIME_FORMAT)
     age_threshold = datetime.now() - timedelta(minutes=5)
-    if news_age < age_threshold:
-        redis_client.set(REDIS_KEY_NAVBAR_NEWS, '')
+    if news_age < age_threshold and redis_client.get(REDIS_KEY_NAVBAR_NEWS):
+        clear_navbar_news()
+
+
+def job(name: str, function: Callable[[], int or None]) -> Job:
+    return Job(name, function, BACKGROUND_JOB_INTERVAL_SECONDS.get(name, CYCLIC_TASKS_FREQUENCY_SECONDS))
 
 
 if __name__ == "__main__":
     message = "-------- background started --------"
     logger.info(message)
-    while True:
-        with app.app_context():
-            reset_failed_login_attempts(db.session)
-            logout_inactive_users(db.session)
-            clean_navbar_news()
-        if DEBUG_MODE_ON:
-            message = "Cyclic tasks executed"
-            logger.info(message)
-        time.sleep(CYCLIC_TASKS_FREQUENCY_SECONDS)
+    scheduler = Scheduler(app, jobs=[
+        job('flush_user_activity', lambda: flush_user_activity(db.session)),
+        job('logout_inactive_users', lambda: logout_inactive_users(db.session)),
+        job('clean_navbar_news', clean_navbar_news),
+        job('deliver_emails', deliver_emails),
+    ])
+    scheduler.run_forever()
@@ -0,0 +1,42 @@
+import argparse
+import json
+import sys
+
+COMPARED_METRICS = ['throughput_per_second', 'p50_ms', 'p95_ms', 'p99_ms']
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Allowed p95 regression in percent.')
+    return parser.parse_args()
+
+
+def change(before: float, after: float) -> float:
+    return (after - before) / before * 100 if before else 0.0
+
+
+def main():
+    args = parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"baseline {baseline['meta']['commit']} -> candidate {candidate['meta']['commit']}")
+    regressions = []
+    for name, after in candidate['results'].items():
+        before = baseline['results'].get(name)
+        if not before: continue
+        changes = '  '.join(f'{m} {before[m]:>9} -> {after[m]:>9} ({change(before[m], after[m]):+6.1f}%)'
+                            for m in COMPARED_METRICS)
+        print(f'{name:28} {changes}')
+        if change(before['p95_ms'], after['p95_ms']) > args.threshold:
+            regressions.append(name)
+    if regressions:
+        print(f"p95 regressions above {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
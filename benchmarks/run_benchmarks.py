@@ -0,0 +1,301 @@
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRECTORY)
+
+BENCHMARK_PASSWORD = 'benchmark'
+SEED_CHUNK_SIZE = 5000
+COLD_START_TARGET_SECONDS = 1.0
+COLD_START_SCRIPT = ("import sys, time; started = time.perf_counter(); import configuration; "
+                     "configuration.DB_CONNECTION_STRING = sys.argv[1]; from app import app; "
+                     "print(time.perf_counter() - started)")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Load test and micro benchmarks for the book cafe app.')
+    parser.add_argument('--db-url', default=None, help='Empty database to use, defaults to a temporary sqlite file.')
+    parser.add_argument('--redis-url', default=None, help='Redis to use, defaults to an in-process fakeredis.')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=500, help='Requests per scenario.')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--sse-clients', type=int, default=50)
+    parser.add_argument('--sweep-runs', type=int, default=20)
+    parser.add_argument('--cold-start-runs', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='benchmark_results.json')
+    return parser.parse_args()
+
+
+def configure(args: argparse.Namespace) -> str:
+    import configuration
+    db_url = args.db_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bookcafe_bench_'), 'bench.db')}"
+    configuration.DB_CONNECTION_STRING = db_url
+    if args.redis_url:
+        configuration.REDIS_CONNECTION_STRING = args.redis_url
+    else:
+        import fakeredis
+        from book_cafe.redis import redis_client
+        redis_client.provider_class = fakeredis.FakeStrictRedis
+    return db_url
+
+
+def seed(app, books: int, users: int, rng: random.Random):
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    from book_cafe.db_functions import initialize_database
+    from book_cafe.db_objects import db, Book, User
+    from configuration import PASSWORD_HASH_METHOD
+    with app.app_context():
+        db.create_all()
+        if Book.query.first() or User.query.first():
+            raise SystemExit('The benchmark database must be empty.')
+        password_hash = generate_password_hash(BENCHMARK_PASSWORD, PASSWORD_HASH_METHOD)
+        user_rows = [{'username': 'Admin', 'password': password_hash}]
+        user_rows += [{'username': f'bench{i}', 'password': password_hash} for i in range(users)]
+        db.session.execute(insert(User), user_rows)
+        db.session.commit()
+        initialize_database()
+        admin_id = User.get_user_by_name('Admin').id
+        words = ['moon', 'coffee', 'library', 'garden', 'river', 'shadow', 'winter', 'story', 'night', 'machine']
+        for start in range(0, books, SEED_CHUNK_SIZE):
+            rows = [{'title': f'{rng.choice(words).title()} {rng.choice(words)} {i}',
+                     'author': f'Author {i % max(books // 20, 1)}',
+                     'description': ' '.join(rng.choice(words) for _ in range(60)),
+                     'user_created': admin_id, 'date_created': datetime.now()}
+                    for i in range(start, min(start + SEED_CHUNK_SIZE, books))]
+            Book.bulk_add_new(rows)
+            db.session.commit()
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values: return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], errors: int, wall_seconds: float) -> dict:
+    values = sorted(latencies)
+    return {'requests': len(values) + errors, 'errors': errors,
+            'throughput_per_second': round(len(values) / wall_seconds, 2) if wall_seconds else 0.0,
+            'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+            'p50_ms': round(percentile(values, 50) * 1000, 3),
+            'p95_ms': round(percentile(values, 95) * 1000, 3),
+            'p99_ms': round(percentile(values, 99) * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3) if values else 0.0}
+
+
+def run_load(requests: int, concurrency: int, client_factory: Callable, call: Callable) -> dict:
+    local = threading.local()
+    latencies, errors, lock = [], [0], threading.Lock()
+
+    def one_request(i: int):
+        if not hasattr(local, 'client'):
+            local.client = client_factory()
+        started = time.perf_counter()
+        ok = call(local.client, i)
+        elapsed = time.perf_counter() - started
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, range(requests)))
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def logged_in_client(app, username: str, search: dict or None = None):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': BENCHMARK_PASSWORD})
+    if search is not None:
+        client.post('/find_book', data=search)
+    return client
+
+
+def benchmark_requests(app, args: argparse.Namespace, rng: random.Random) -> dict:
+    results = dict()
+    user_counter = iter(range(10 ** 9))
+
+    def user_client(search: dict or None = None) -> Callable:
+        return lambda: logged_in_client(app, f'bench{next(user_counter) % args.users}', search)
+
+    def login(client, i: int) -> bool:
+        username = f'bench{rng.randrange(args.users)}'
+        return client.post('/login', data={'username': username, 'password': BENCHMARK_PASSWORD}).status_code == 302
+    results['login'] = run_load(args.requests, args.concurrency, app.test_client, login)
+
+    searches = {'find_book_all': {'title': '', 'author': '', 'sort_by': 'title'},
+                'find_book_title': {'title': 'coffee', 'author': '', 'sort_by': 'title'},
+                'find_book_author': {'title': '', 'author': 'Author 1', 'sort_by': 'author'},
+                'find_book_relevance': {'title': 'moon river', 'author': '', 'sort_by': 'relevance'}}
+    for name, search in searches.items():
+        results[name] = run_load(args.requests, args.concurrency, user_client(search),
+                                 lambda client, i: client.get('/find_book').status_code == 200)
+
+    cursor_client = logged_in_client(app, 'bench0', searches['find_book_all'])
+    next_page = re.search(r'data-next="([^"]+)"', cursor_client.get('/find_book').get_data(as_text=True))
+    if next_page:
+        url = next_page.group(1).replace('&amp;', '&')
+        results['find_book_next_page'] = run_load(args.requests, args.concurrency, user_client(searches['find_book_all']),
+                                                  lambda client, i: client.get(url).status_code == 200)
+
+    from book_cafe.db_functions import query_book_page
+    from book_cafe.db_objects import Book, db
+
+    def uncached_query(client, i: int) -> bool:
+        search = list(searches.values())[i % len(searches)]
+        with app.app_context():
+            return query_book_page(search['author'], search['title'], search['sort_by']) is not None
+    results['query_book_page_uncached'] = run_load(args.requests, args.concurrency, lambda: None, uncached_query)
+
+    admin = lambda: logged_in_client(app, 'Admin')
+
+    def add_book(client, i: int) -> bool:
+        data = {'title': f'Benchmark book {i}', 'author': 'Benchmark', 'description': 'added by the benchmark'}
+        return client.post('/add_book', data=data).status_code == 302
+    results['add_book'] = run_load(args.requests, args.concurrency, admin, add_book)
+
+    with app.app_context():
+        added_ids = [b.id for b in db.session.query(Book.id).filter(Book.author == 'Benchmark').all()]
+    single_ids, batch_ids = added_ids[:len(added_ids) // 2], added_ids[len(added_ids) // 2:]
+    results['delete_book'] = run_load(len(single_ids), args.concurrency, admin,
+                                      lambda client, i: client.post(f'/delete_book/{single_ids[i]}').status_code == 302)
+    results['delete_books_batch'] = run_load(1, 1, admin, lambda client, i: client.post(
+        '/api/books/batch', json={'delete': batch_ids}).get_json() == {'deleted': len(batch_ids), 'updated': 0})
+    return results
+
+
+def benchmark_sse(app, clients: int) -> dict:
+    from book_cafe.navbar import set_navbar_news
+    connected, received = threading.Barrier(clients + 1), []
+    lock = threading.Lock()
+
+    def listen():
+        response = app.test_client().get('/navbar_stream', buffered=False)
+        events = iter(response.response)
+        next(events)
+        connected.wait()
+        for event in events:
+            if b'benchmark news' in event:
+                with lock:
+                    received.append(time.perf_counter())
+                break
+        response.close()
+
+    threads = [threading.Thread(target=listen, daemon=True) for _ in range(clients)]
+    for t in threads: t.start()
+    connected.wait()
+    time.sleep(0.5)
+    published = time.perf_counter()
+    with app.app_context():
+        set_navbar_news('benchmark news')
+    for t in threads: t.join(timeout=30)
+    latencies = [r - published for r in received]
+    return summarize(latencies, clients - len(latencies), max(received, default=published) - published)
+
+
+def benchmark_sweeps(runs: int) -> dict:
+    import background
+    from book_cafe.db_objects import db
+    results = dict()
+    for name, sweep in {'flush_user_activity': background.flush_user_activity,
+                        'logout_inactive_users': background.logout_inactive_users}.items():
+        latencies = []
+        for _ in range(runs):
+            with background.app.app_context():
+                started = time.perf_counter()
+                sweep(db.session)
+                latencies.append(time.perf_counter() - started)
+        results[name] = summarize(latencies, 0, sum(latencies))
+    return results
+
+
+def benchmark_catalogue_replica(app, requests: int) -> dict:
+    import tracemalloc
+    from book_cafe.catalogue_replica import load_snapshot
+    searches = [('', '', 'title'), ('', 'coffee', 'title'), ('Author 1', '', 'author'), ('', '', 'relevance')]
+    with app.app_context():
+        started = time.perf_counter()
+        snapshot = load_snapshot()
+        load_seconds = time.perf_counter() - started
+        del snapshot
+        tracemalloc.start()
+        snapshot = load_snapshot()
+        traced_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    books = len(snapshot.books)
+    load = summarize([load_seconds], 0, load_seconds)
+    load.update(books=books, estimated_bytes=snapshot.memory_bytes(), traced_bytes=traced_bytes,
+                traced_bytes_per_100k_books=round(traced_bytes * 100000 / books) if books else 0)
+    page = run_load(requests, 1, lambda: None,
+                    lambda client, i: snapshot.page(*searches[i % len(searches)], after=None, limit=21) is not None)
+    return {'catalogue_replica_load': load, 'catalogue_replica_page': page}
+
+
+def benchmark_cold_start(runs: int, db_url: str) -> dict:
+    latencies = []
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT_DIRECTORY, os.environ.get('PYTHONPATH')])))
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', COLD_START_SCRIPT, db_url], env=env, text=True)
+        latencies.append(float(output.strip().splitlines()[-1]))
+    result = summarize(latencies, 0, sum(latencies))
+    result['target_ms'] = COLD_START_TARGET_SECONDS * 1000
+    result['within_target'] = result['p50_ms'] <= result['target_ms']
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIRECTORY, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    db_url = configure(args)
+    from app import app
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    started = time.perf_counter()
+    seed(app, args.books, args.users, rng)
+    seed_seconds = time.perf_counter() - started
+    results = benchmark_requests(app, args, rng)
+    results['navbar_stream_broadcast'] = benchmark_sse(app, args.sse_clients)
+    results.update(benchmark_sweeps(args.sweep_runs))
+    results.update(benchmark_catalogue_replica(app, args.requests))
+    results['cold_start'] = benchmark_cold_start(args.cold_start_runs, db_url)
+
+    report = {'meta': {'commit': git_commit(), 'timestamp': datetime.now().isoformat(timespec='seconds'),
+                       'python': platform.python_version(), 'database': db_url.split(':', 1)[0],
+                       'redis': 'redis' if args.redis_url else 'fakeredis', 'books': args.books, 'users': args.users,
+                       'requests': args.requests, 'concurrency': args.concurrency,
+                       'seed_seconds': round(seed_seconds, 2)},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for name, r in results.items():
+        print(f"{name:28} {r['throughput_per_second']:>10}/s  p50 {r['p50_ms']:>9} ms  p95 {r['p95_ms']:>9} ms  "
+              f"p99 {r['p99_ms']:>9} ms  errors {r['errors']}")
+    print(f'Results written to {args.output}.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import time
+from datetime import datetime
+from threading import Lock
+
+from book_cafe.exceptions import reddis_exception
+from book_cafe.redis import redis_client
+from configuration import ACTIVITY_RECORD_INTERVAL_SECONDS, ACTIVITY_FLUSH_GRACE_SECONDS
+from constants import REDIS_KEY_USER_ACTIVITY, REDIS_KEY_USER_ACTIVITY_FLUSHED
+
+last_recorded = dict()
+last_recorded_lock = Lock()
+
+
+def record_activity(user_id: int, force: bool = False):
+    now = time.time()
+    with last_recorded_lock:
+        if not force and now - last_recorded.get(user_id, 0) < ACTIVITY_RECORD_INTERVAL_SECONDS: return
+        last_recorded[user_id] = now
+    store_activity(user_id, now)
+
+
+@reddis_exception()
+def store_activity(user_id: int, timestamp: float):
+    redis_client.zadd(REDIS_KEY_USER_ACTIVITY, {str(user_id): timestamp})
+
+
+@reddis_exception()
+def get_unflushed_activity() -> tuple[dict[int, datetime], float]:
+    flush_started = time.time()
+    flushed_until = float(redis_client.get(REDIS_KEY_USER_ACTIVITY_FLUSHED) or 0)
+    entries = redis_client.zrangebyscore(REDIS_KEY_USER_ACTIVITY, flushed_until - ACTIVITY_FLUSH_GRACE_SECONDS, '+inf',
+                                         withscores=True)
+    return {int(user_id): datetime.fromtimestamp(score) for user_id, score in entries}, flush_started
+
+
+@reddis_exception()
+def mark_activity_flushed(flush_started: float, prune_before: datetime):
+    redis_client.set(REDIS_KEY_USER_ACTIVITY_FLUSHED, flush_started)
+    redis_client.zremrangebyscore(REDIS_KEY_USER_ACTIVITY, '-inf', f'({prune_before.timestamp()}')
+
+
+@reddis_exception()
+def get_active_user_ids(since: datetime) -> list[int]:
+    return [int(user_id) for user_id in redis_client.zrangebyscore(REDIS_KEY_USER_ACTIVITY, since.timestamp(), '+inf')]
+
+
+if __name__ == "__main__":
+    pass
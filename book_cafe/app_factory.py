@@ -0,0 +1,75 @@
+import os
+
+import click
+from flask import Flask
+from flask_toastr import Toastr
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from book_cafe.catalogue_replica import catalogue_replica
+from book_cafe.commands import covers_cli, books_cli, init_db_command
+from book_cafe.db_objects import db
+from book_cafe.db_routing import engine_options, replica_binds, pool_metric_lines
+from book_cafe.metrics import init_metrics, register_metric_provider
+from book_cafe.navbar import navbar_news_stream
+from book_cafe.page_cache import render_book_card
+from book_cafe.redis import redis_client, circuit_breaker
+from book_cafe.user_management import login_manager
+from confidential import SECRET_KEY
+from configuration import DB_CONNECTION_STRING, DB_REPLICA_CONNECTION_STRINGS, REDIS_CONNECTION_STRING, \
+    COVER_USE_X_SENDFILE, JINJA_BYTECODE_CACHE_DIRECTORY, BOOK_BULK_MAX_REQUEST_BYTES, TRUSTED_PROXY_HOPS
+
+toastr = Toastr()
+
+
+def create_app(import_name: str, config: dict or None = None) -> Flask:
+    app = Flask(import_name)
+    app.config["SQLALCHEMY_DATABASE_URI"] = DB_CONNECTION_STRING
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(DB_CONNECTION_STRING)
+    app.config["SQLALCHEMY_BINDS"] = replica_binds(DB_REPLICA_CONNECTION_STRINGS)
+    app.config["REDIS_URL"] = REDIS_CONNECTION_STRING
+    app.config["SECRET_KEY"] = SECRET_KEY
+    app.config["USE_X_SENDFILE"] = COVER_USE_X_SENDFILE
+    app.config["MAX_CONTENT_LENGTH"] = BOOK_BULK_MAX_REQUEST_BYTES
+    app.config.update(config or dict())
+    if TRUSTED_PROXY_HOPS:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+    os.makedirs(JINJA_BYTECODE_CACHE_DIRECTORY, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_BYTECODE_CACHE_DIRECTORY)
+    app.jinja_env.globals['render_book_card'] = render_book_card
+    db.init_app(app)
+    redis_client.init_app(app)
+    login_manager.init_app(app)
+    toastr.init_app(app)
+    init_metrics(app)
+    register_metric_provider(pool_metric_lines)
+    register_metric_provider(circuit_breaker.metric_lines)
+    catalogue_replica.init_app(app)
+    register_metric_provider(catalogue_replica.metric_lines)
+    app.register_blueprint(navbar_news_stream)
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(covers_cli)
+    app.cli.add_command(books_cli)
+    if running_from_cli():
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    dispose_engines_after_fork(app)
+    return app
+
+
+def running_from_cli() -> bool:
+    return click.get_current_context(silent=True) is not None
+
+
+def dispose_engines_after_fork(app: Flask):
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    def dispose_engines():
+        for engine in engines:
+            engine.dispose(close=False)
+    os.register_at_fork(after_in_child=dispose_engines)
+
+
+if __name__ == "__main__":
+    pass
@@ -1,17 +1,110 @@
+import atexit
+import json
 import logging
-from logging import handlers, Logger
+import os
+import queue
+import random
+from collections import Counter
+from logging import handlers, Logger, LogRecord
+from threading import Lock
 
 from injector import Module, provider, singleton
 
-from configuration import LOGFILE_NAME, LOGFILES_MAX_BYTES, NUM_OF_LOGFILE_BACKUPS
+from configuration import LOGFILE_NAME, LOGFILES_MAX_BYTES, NUM_OF_LOGFILE_BACKUPS, LOG_QUEUE_SIZE, LOG_BATCH_SIZE, \
+    LOG_FORMAT_JSON, LOG_SAMPLE_RATES
+
+
+class Batched_Rotating_File_Handler(handlers.RotatingFileHandler):
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class Json_Formatter(logging.Formatter):
+    def format(self, record: LogRecord) -> str:
+        return json.dumps({'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                           'location': f'{record.filename}:{record.lineno}', 'message': record.getMessage()})
+
+
+class Batching_Queue_Listener(handlers.QueueListener):
+    def __init__(self, log_queue: queue.Queue, *log_handlers, batch_size: int):
+        super().__init__(log_queue, *log_handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.pending = 0
+
+    def handle(self, record: LogRecord):
+        super().handle(record)
+        self.pending += 1
+        if self.pending >= self.batch_size or self.queue.empty():
+            for handler in self.handlers:
+                handler.flush_batch()
+            self.pending = 0
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class Bounded_Queue_Handler(handlers.QueueHandler):
+    def __init__(self, file_handler: logging.Handler, queue_size: int, batch_size: int):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.file_handler = file_handler
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.dropped = Counter()
+        self.listener = None
+        self.pid = None
+        self.start_lock = Lock()
+
+    def start_listener(self):
+        with self.start_lock:
+            if self.pid == os.getpid(): return
+            self.queue = queue.Queue(maxsize=self.queue_size)
+            self.listener = Batching_Queue_Listener(self.queue, self.file_handler, batch_size=self.batch_size)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def stop_listener(self):
+        with self.start_lock:
+            if self.pid != os.getpid(): return
+            self.listener.stop()
+            self.pid = None
+
+    def enqueue(self, record: LogRecord):
+        if self.pid != os.getpid():
+            self.start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped[record.levelname] += 1
+
+
+class Sampling_Filter(logging.Filter):
+    def __init__(self, sample_rates: dict):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record: LogRecord) -> bool:
+        if not getattr(record, 'high_volume', False): return True
+        return random.random() < self.sample_rates.get(record.levelname, 1.0)
+
+
+def logging_stats() -> dict:
+    return {'queued': handler.queue.qsize(), 'queue_size': handler.queue_size, 'dropped': dict(handler.dropped)}
+
 
 logger = logging.getLogger(__name__)
-handler = handlers.RotatingFileHandler(filename=LOGFILE_NAME, maxBytes=LOGFILES_MAX_BYTES,
-                                       backupCount=NUM_OF_LOGFILE_BACKUPS)
-formater = logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(filename)s:%(lineno)d | %(message)s")
-handler.setFormatter(formater)
+file_handler = Batched_Rotating_File_Handler(filename=LOGFILE_NAME, maxBytes=LOGFILES_MAX_BYTES,
+                                             backupCount=NUM_OF_LOGFILE_BACKUPS, delay=True)
+formater = Json_Formatter() if LOG_FORMAT_JSON else \
+    logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(filename)s:%(lineno)d | %(message)s")
+file_handler.setFormatter(formater)
+handler = Bounded_Queue_Handler(file_handler, LOG_QUEUE_SIZE, LOG_BATCH_SIZE)
+handler.addFilter(Sampling_Filter(LOG_SAMPLE_RATES))
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
+atexit.register(handler.stop_listener)
 
 
 class LoggerModule(Module):
@@ -22,4 +115,4 @@ class LoggerModule(Module):
 
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,54 @@
+import json
+
+from book_cafe.app_logger import logger
+from book_cafe.exceptions import reddis_exception
+from book_cafe.redis import redis_client
+from configuration import CATALOGUE_REPLICA_FEED_LENGTH
+from constants import REDIS_KEY_CATALOGUE_FEED, REDIS_KEY_CATALOGUE_FEED_VERSION
+
+PUBLISH_CHANGES_SCRIPT = """
+local version = redis.call('incr', KEYS[1])
+redis.call('xadd', KEYS[2], 'MAXLEN', '~', ARGV[2], version .. '-0', 'changes', ARGV[1])
+return version
+"""
+published_version = 0
+reload_pending = False
+
+
+def publish_catalogue_changes(book_ids: set[int], reload: bool = False) -> int or None:
+    global published_version, reload_pending
+    if not book_ids and not reload and not reload_pending: return None
+    changes = {'reload': True} if reload or reload_pending else {'ids': sorted(book_ids)}
+    version = append_catalogue_changes(changes)
+    if version is None:
+        if not reload_pending: logger.warning("Catalogue changes not published, replicas will reload.")
+        reload_pending = True
+        return None
+    reload_pending = False
+    published_version = max(published_version, version)
+    return version
+
+
+@reddis_exception()
+def append_catalogue_changes(changes: dict) -> int:
+    return int(redis_client.eval(PUBLISH_CHANGES_SCRIPT, 2, REDIS_KEY_CATALOGUE_FEED_VERSION, REDIS_KEY_CATALOGUE_FEED,
+                                 json.dumps(changes, separators=(',', ':')), CATALOGUE_REPLICA_FEED_LENGTH))
+
+
+@reddis_exception()
+def get_feed_version() -> int:
+    return int(redis_client.get(REDIS_KEY_CATALOGUE_FEED_VERSION) or 0)
+
+
+@reddis_exception()
+def read_catalogue_changes(after_version: int) -> tuple[int, list[tuple[int, dict]]]:
+    pipeline = redis_client.pipeline(transaction=True)
+    pipeline.get(REDIS_KEY_CATALOGUE_FEED_VERSION)
+    pipeline.xrange(REDIS_KEY_CATALOGUE_FEED, min=f'{after_version + 1}-0', max='+')
+    version, entries = pipeline.execute()
+    changes = [(int(entry_id.split('-')[0]), json.loads(fields['changes'])) for entry_id, fields in entries]
+    return int(version or 0), changes
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,162 @@
+import csv
+import json
+import os
+import zlib
+from datetime import datetime
+from io import StringIO
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+from book_cafe.db_functions import encode_page_cursor
+from book_cafe.db_objects import Book, db
+from configuration import BOOK_EXPORT_BUFFER_BYTES, BOOK_BULK_MAX_BOOKS
+
+EXPORT_FIELDS = ['id', 'title', 'author', 'description', 'cursor']
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EDITABLE_FIELDS = ['title', 'author', 'description']
+
+
+def read_book_records(path: str) -> Iterator[dict]:
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip(): yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def chunked(records: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(records)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def to_book_row(record: dict, user_id: int, date_created: datetime) -> dict or None:
+    title = (record.get('title') or '').strip()
+    author = (record.get('author') or '').strip()
+    if not title or not author: return None
+    if len(title) > Book.title.type.length or len(author) > Book.author.type.length: return None
+    description = (record.get('description') or '')[:Book.description.type.length]
+    return {'title': title, 'author': author, 'description': description, 'user_created': user_id,
+            'date_created': date_created}
+
+
+def parse_book_batch(batch) -> tuple[list[int], list[dict]]:
+    if not isinstance(batch, dict) or set(batch) - {'delete', 'update'}:
+        raise ValueError("A batch is an object with 'delete' and 'update' lists.")
+    delete_ids, changes = batch.get('delete') or [], batch.get('update') or []
+    if not isinstance(delete_ids, list) or not isinstance(changes, list):
+        raise ValueError("'delete' and 'update' must be lists.")
+    if len(delete_ids) + len(changes) > BOOK_BULK_MAX_BOOKS:
+        raise ValueError(f"At most {BOOK_BULK_MAX_BOOKS} books per batch.")
+    if not all(type(i) is int for i in delete_ids):
+        raise ValueError("Book ids must be integers.")
+    deleted = dict.fromkeys(delete_ids)
+    changes = {c['id']: c for c in map(to_book_change, changes) if c['id'] not in deleted}
+    return list(deleted), list(changes.values())
+
+
+def to_book_change(change) -> dict:
+    if not isinstance(change, dict) or type(change.get('id')) is not int:
+        raise ValueError("Every update needs an integer 'id'.")
+    values = {f: change[f] for f in EDITABLE_FIELDS if f in change}
+    if not values or set(change) - {'id', *EDITABLE_FIELDS}:
+        raise ValueError(f"An update changes some of {', '.join(EDITABLE_FIELDS)} and nothing else.")
+    for field, value in values.items():
+        if not isinstance(value, str) or len(value) > getattr(Book, field).type.length:
+            raise ValueError(f"Invalid {field} for book {change['id']}.")
+        if field != 'description':
+            values[field] = value.strip()
+            if not values[field]: raise ValueError(f"Empty {field} for book {change['id']}.")
+    return dict(values, id=change['id'])
+
+
+def load_checkpoint(checkpoint_path: str, source_path: str) -> int:
+    if not os.path.exists(checkpoint_path): return 0
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    return checkpoint['processed'] if checkpoint.get('source') == os.path.abspath(source_path) else 0
+
+
+def save_checkpoint(checkpoint_path: str, source_path: str, processed: int):
+    with open(f'{checkpoint_path}.tmp', 'w') as f:
+        json.dump({'source': os.path.abspath(source_path), 'processed': processed}, f)
+    os.replace(f'{checkpoint_path}.tmp', checkpoint_path)
+
+
+def import_books(path: str, user_id: int, chunk_size: int, checkpoint_path: str,
+                 progress: Callable[[dict], None]) -> dict:
+    processed = load_checkpoint(checkpoint_path, path)
+    stats = {'processed': processed, 'inserted': 0, 'duplicates': 0, 'rejected': 0}
+    records = islice(read_book_records(path), processed, None)
+    for chunk in chunked(records, chunk_size):
+        date_created = datetime.now()
+        rows = dict()
+        for record in chunk:
+            row = to_book_row(record, user_id, date_created)
+            if not row:
+                stats['rejected'] += 1
+            elif (row['title'], row['author']) in rows:
+                stats['duplicates'] += 1
+            else:
+                rows[(row['title'], row['author'])] = row
+        existing = Book.get_existing_title_authors(list(rows))
+        new_books = [row for key, row in rows.items() if key not in existing]
+        Book.bulk_add_new(new_books)
+        db.session.commit()
+        stats['processed'] += len(chunk)
+        stats['inserted'] += len(new_books)
+        stats['duplicates'] += len(rows) - len(new_books)
+        save_checkpoint(checkpoint_path, path, stats['processed'])
+        progress(stats)
+    if os.path.exists(checkpoint_path): os.remove(checkpoint_path)
+    return stats
+
+
+def export_records(author: str, title: str, sort_by: str, after: tuple or None = None) -> Iterator[dict]:
+    for b in Book.stream_books(author=author, title=title, sort_by=sort_by, after=after):
+        yield {'id': b.id, 'title': b.title, 'author': b.author, 'description': b.description,
+               'cursor': encode_page_cursor(b)}
+
+
+def to_ndjson(records: Iterable[dict]) -> Iterator[str]:
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def to_csv(records: Iterable[dict]) -> Iterator[str]:
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def buffered(chunks: Iterable[str], size: int = BOOK_EXPORT_BUFFER_BYTES) -> Iterator[bytes]:
+    buffer, buffered_bytes = [], 0
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        buffer.append(data)
+        buffered_bytes += len(data)
+        if buffered_bytes >= size:
+            yield b''.join(buffer)
+            buffer, buffered_bytes = [], 0
+    if buffer: yield b''.join(buffer)
+
+
+def gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data: yield data
+    yield compressor.flush()
+
+
+if __name__ == "__main__":
+    pass
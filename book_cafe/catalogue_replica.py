@@ -0,0 +1,259 @@
+import os
+import sys
+import time
+from bisect import bisect_right, insort
+from collections import Counter
+from threading import Lock, Thread
+from typing import NamedTuple
+
+from flask import Flask
+from sqlalchemy.exc import SQLAlchemyError
+
+from book_cafe import catalogue_feed
+from book_cafe.app_logger import logger
+from book_cafe.catalogue_feed import get_feed_version, read_catalogue_changes
+from book_cafe.db_objects import Book
+from book_cafe.exceptions import sql_alchemy_exception
+from configuration import CATALOGUE_REPLICA_ENABLED, CATALOGUE_REPLICA_SYNC_SECONDS, \
+    CATALOGUE_REPLICA_MAX_STALENESS_SECONDS, CATALOGUE_REPLICA_RELOAD_SECONDS
+
+INCREMENTAL_CHANGE_LIMIT = 100
+
+
+class Reload_Required(Exception):
+    pass
+
+
+class Replica_Book:
+    __slots__ = ('id', 'title', 'author', 'description', 'cover_hash', 'title_key', 'author_key')
+
+    def __init__(self, book_id: int, title: str, author: str, description: str, cover_hash: str or None,
+                 title_key: str, author_key: str):
+        self.id = book_id
+        self.title = title
+        self.author = author
+        self.description = description
+        self.cover_hash = cover_hash
+        self.title_key = title_key
+        self.author_key = author_key
+
+
+class Replica_Row(NamedTuple):
+    id: int
+    title: str
+    author: str
+    description: str
+    cover_hash: str or None
+    sort_key: str or float
+
+
+def lowered(text: str) -> str:
+    key = text.lower()
+    return text if key == text else key
+
+
+def make_book(strings: dict[str, str], book_id: int, title: str, author: str, description: str,
+              cover_hash: str or None) -> Replica_Book:
+    author = strings.setdefault(author, author)
+    author_key = author.lower()
+    return Replica_Book(book_id, title, author, description, cover_hash, lowered(title),
+                        author if author_key == author else strings.setdefault(author_key, author_key))
+
+
+def by_title(book: Replica_Book) -> tuple:
+    return book.title, book.id
+
+
+def by_author(book: Replica_Book) -> tuple:
+    return book.author, book.id
+
+
+def by_id(book: Replica_Book) -> int:
+    return book.id
+
+
+class Catalogue_Snapshot:
+    __slots__ = ('books', 'by_title', 'by_author', 'by_id', 'version', 'strings')
+
+    def __init__(self, books: dict[int, Replica_Book], version: int, strings: dict[str, str],
+                 orderings: tuple[list, list, list] or None = None):
+        self.books = books
+        self.version = version
+        self.strings = strings
+        if orderings is None:
+            orderings = (sorted(books.values(), key=by_title), sorted(books.values(), key=by_author),
+                         sorted(books.values(), key=by_id))
+        self.by_title, self.by_author, self.by_id = orderings
+
+    def updated(self, changes: list[tuple[int, dict]]) -> "Catalogue_Snapshot":
+        if any(entry.get('reload') for version, entry in changes): raise Reload_Required()
+        book_ids = sorted({book_id for version, entry in changes for book_id in entry['ids']})
+        rows = {r.id: r for chunk in Book.id_chunks(book_ids) for r in Book.get_replica_rows(chunk)}
+        books, incremental = dict(self.books), len(book_ids) <= INCREMENTAL_CHANGE_LIMIT
+        orderings = (list(self.by_title), list(self.by_author), list(self.by_id)) if incremental else None
+        for book_id in book_ids:
+            old, row = books.pop(book_id, None), rows.get(book_id)
+            new = make_book(self.strings, row.id, row.title, row.author, row.description or '',
+                            row.cover_hash) if row else None
+            if new: books[new.id] = new
+            if incremental:
+                for ordering, key in zip(orderings, (by_title, by_author, by_id)):
+                    if old: del ordering[bisect_right(ordering, key(old), key=key) - 1]
+                    if new: insort(ordering, new, key=key)
+        return Catalogue_Snapshot(books, changes[-1][0] if changes else self.version, self.strings, orderings)
+
+    def page(self, author: str, title: str, sort_by: str, after: tuple or None,
+             limit: int or None) -> list[Replica_Row] or None:
+        author_term, title_term = (author or '').lower(), (title or '').lower()
+        if sort_by == 'relevance' and (author_term or title_term): return None
+        if sort_by == 'author':
+            ordering, key, sort_key = self.by_author, by_author, lambda b: b.author
+        elif sort_by == 'relevance':
+            ordering, key, sort_key = self.by_id, by_id, lambda b: 0.0
+        else:
+            ordering, key, sort_key = self.by_title, by_title, lambda b: b.title
+        try:
+            start = 0
+            if after:
+                start = bisect_right(ordering, after[1] if key is by_id else tuple(after), key=key)
+        except TypeError:
+            raise ValueError(f"Invalid page cursor {after}.")
+        rows = []
+        for i in range(start, len(ordering)):
+            book = ordering[i]
+            if title_term not in book.title_key or author_term not in book.author_key: continue
+            rows.append(Replica_Row(book.id, book.title, book.author, book.description, book.cover_hash,
+                                    sort_key(book)))
+            if limit and len(rows) >= limit: break
+        return rows
+
+    def memory_bytes(self) -> int:
+        seen, size = set(), sys.getsizeof(self.books) + sys.getsizeof(self.strings)
+        size += sum(sys.getsizeof(ordering) for ordering in (self.by_title, self.by_author, self.by_id))
+        for book in self.books.values():
+            size += sys.getsizeof(book)
+            for value in (book.id, book.title, book.author, book.description, book.cover_hash, book.title_key,
+                          book.author_key):
+                if value is not None and id(value) not in seen:
+                    seen.add(id(value))
+                    size += sys.getsizeof(value)
+        return size
+
+
+@sql_alchemy_exception()
+def load_snapshot() -> Catalogue_Snapshot or None:
+    version = get_feed_version()
+    if version is None: return None
+    strings = dict()
+    books = {r.id: make_book(strings, r.id, r.title, r.author, r.description or '', r.cover_hash)
+             for r in Book.get_replica_rows()}
+    return Catalogue_Snapshot(books, version, strings)
+
+
+class Catalogue_Replica:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.app = None
+        self.snapshot = None
+        self.pid = os.getpid()
+        self.loading = False
+        self.loaded_at = 0.0
+        self.last_sync = 0.0
+        self.memory = 0
+        self.counters = Counter()
+        self.lock = Lock()
+
+    def init_app(self, app: Flask):
+        self.app = app
+
+    def get(self) -> Catalogue_Snapshot or None:
+        if not self.enabled or self.app is None: return None
+        if self.pid != os.getpid():
+            self.pid, self.lock, self.loading = os.getpid(), Lock(), False
+        snapshot = self.snapshot
+        if snapshot is None or time.monotonic() - self.loaded_at >= CATALOGUE_REPLICA_RELOAD_SECONDS:
+            self.start_loading()
+        if snapshot is not None and (catalogue_feed.published_version > snapshot.version or catalogue_feed.reload_pending
+                                     or time.monotonic() - self.last_sync >= CATALOGUE_REPLICA_SYNC_SECONDS):
+            snapshot = self.sync(blocking=catalogue_feed.published_version > snapshot.version)
+            if snapshot is None: self.start_loading()
+        if snapshot is None or time.monotonic() - self.last_sync > CATALOGUE_REPLICA_MAX_STALENESS_SECONDS:
+            self.counters['fallbacks'] += 1
+            return None
+        return snapshot
+
+    def sync(self, blocking: bool) -> Catalogue_Snapshot or None:
+        if not self.lock.acquire(blocking=blocking): return self.snapshot
+        try:
+            snapshot = self.snapshot
+            if snapshot is None: return None
+            if catalogue_feed.reload_pending and catalogue_feed.publish_catalogue_changes(set()) is None:
+                return None
+            result = read_catalogue_changes(snapshot.version)
+            if result is None: return snapshot
+            feed_version, changes = result
+            if feed_version != snapshot.version:
+                try:
+                    if not contiguous(snapshot.version, feed_version, changes): raise Reload_Required()
+                    snapshot = snapshot.updated(changes)
+                except Reload_Required:
+                    self.snapshot = None
+                    self.counters['reloads'] += 1
+                    return None
+                except SQLAlchemyError:
+                    logger.error("SQLAlchemyError - catalogue replica changes not applied.")
+                    return snapshot
+                self.snapshot = snapshot
+                self.counters['synced_changes'] += len(changes)
+            self.last_sync = time.monotonic()
+            return snapshot
+        finally:
+            self.lock.release()
+
+    def start_loading(self):
+        with self.lock:
+            if self.loading: return
+            self.loading = True
+        Thread(target=self.load, daemon=True).start()
+
+    def load(self):
+        try:
+            started = time.perf_counter()
+            with self.app.app_context():
+                snapshot = load_snapshot()
+            if snapshot is None: return
+            memory = snapshot.memory_bytes()
+            with self.lock:
+                self.snapshot, self.memory, self.loaded_at = snapshot, memory, time.monotonic()
+                self.last_sync = 0.0
+            self.counters['loads'] += 1
+            logger.info(f"Catalogue replica loaded: {len(snapshot.books)} books, {memory // 1024} KiB, "
+                        f"{time.perf_counter() - started:.2f} s.")
+        finally:
+            self.loading = False
+
+    def metric_lines(self) -> list[str]:
+        snapshot = self.snapshot
+        lines = ['# HELP bookcafe_catalogue_replica_books Books held by the in-process catalogue replica.',
+                 '# TYPE bookcafe_catalogue_replica_books gauge',
+                 f'bookcafe_catalogue_replica_books {len(snapshot.books) if snapshot else 0}',
+                 '# HELP bookcafe_catalogue_replica_bytes Estimated memory of the catalogue replica at its last load.',
+                 '# TYPE bookcafe_catalogue_replica_bytes gauge',
+                 f'bookcafe_catalogue_replica_bytes {self.memory}',
+                 '# HELP bookcafe_catalogue_replica_events_total Loads, reloads, applied changes and fallbacks.',
+                 '# TYPE bookcafe_catalogue_replica_events_total counter']
+        lines += [f'bookcafe_catalogue_replica_events_total{{event="{event}"}} {self.counters.get(event, 0)}'
+                  for event in ('loads', 'reloads', 'synced_changes', 'fallbacks')]
+        return lines
+
+
+def contiguous(after_version: int, feed_version: int, changes: list[tuple[int, dict]]) -> bool:
+    versions = [version for version, entry in changes]
+    return feed_version > after_version and versions == list(range(after_version + 1, feed_version + 1))
+
+
+catalogue_replica = Catalogue_Replica(enabled=CATALOGUE_REPLICA_ENABLED)
+
+
+if __name__ == "__main__":
+    pass
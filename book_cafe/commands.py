@@ -0,0 +1,89 @@
+import time
+
+import click
+from flask.cli import AppGroup, with_appcontext
+
+from book_cafe.catalogue_io import import_books, export_records, to_csv, to_ndjson, buffered, gzipped, EXPORT_MIMETYPES
+from book_cafe.db_functions import migrate_cover_pictures, decode_page_cursor, initialize_database, \
+    rebuild_suggestion_index, rebuild_author_stats
+from book_cafe.db_objects import User, db
+from configuration import COVER_MIGRATION_BATCH_SIZE, BOOK_IMPORT_CHUNK_SIZE, SUGGEST_REBUILD_CHUNK_SIZE
+
+covers_cli = AppGroup('covers', help='Manage the cover picture store.')
+books_cli = AppGroup('books', help='Import and export the book catalogue.')
+
+
+@click.command('init-db', help='Create the schema, roles and search index.')
+@with_appcontext
+def init_db_command():
+    db.create_all()
+    initialize_database()
+    click.echo('Database initialized.')
+
+
+@covers_cli.command('migrate')
+@click.option('--batch-size', default=COVER_MIGRATION_BATCH_SIZE, show_default=True)
+def migrate_covers(batch_size: int):
+    migrated = migrate_cover_pictures(batch_size=batch_size)
+    click.echo(f'{migrated} cover pictures moved to the cover store.')
+
+
+@books_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', default='Admin', show_default=True, help='User recorded as creator.')
+@click.option('--chunk-size', default=BOOK_IMPORT_CHUNK_SIZE, show_default=True)
+@click.option('--checkpoint', 'checkpoint_path', default=None, help='Checkpoint file, defaults to PATH.checkpoint.')
+def import_books_command(path: str, username: str, chunk_size: int, checkpoint_path: str or None):
+    user = User.get_user_by_name(username)
+    if not user:
+        raise click.ClickException(f'Unknown user {username}.')
+    started = time.perf_counter()
+
+    def progress(stats: dict):
+        rate = stats['processed'] / max(time.perf_counter() - started, 1e-9)
+        click.echo(f"{stats['processed']} processed, {stats['inserted']} inserted, {stats['duplicates']} duplicates, "
+                   f"{stats['rejected']} rejected ({rate:.0f} records/s)")
+    stats = import_books(path, user.id, chunk_size, checkpoint_path or f'{path}.checkpoint', progress)
+    click.echo(f"Import finished: {stats['inserted']} books added.")
+
+
+@books_cli.command('rebuild-suggestions')
+@click.option('--chunk-size', default=SUGGEST_REBUILD_CHUNK_SIZE, show_default=True)
+def rebuild_suggestions_command(chunk_size: int):
+    rebuilt = rebuild_suggestion_index(chunk_size)
+    if rebuilt is None:
+        raise click.ClickException('Rebuilding the suggestion index failed, see the log.')
+    click.echo(f"Suggestion index rebuilt with {rebuilt.get('title')} titles and {rebuilt.get('author')} authors.")
+
+
+@books_cli.command('rebuild-author-stats')
+def rebuild_author_stats_command():
+    authors = rebuild_author_stats()
+    if authors is None:
+        raise click.ClickException('Rebuilding the author statistics failed, see the log.')
+    click.echo(f"Author statistics rebuilt with {authors} authors.")
+
+
+@books_cli.command('export')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_MIMETYPES)), default='ndjson',
+              show_default=True)
+@click.option('--output', type=click.File('wb'), default='-', help='Output file, defaults to stdout.')
+@click.option('--gzip', 'use_gzip', is_flag=True, help='Compress the output.')
+@click.option('--title', default='')
+@click.option('--author', default='')
+@click.option('--sort-by', type=click.Choice(['title', 'author', 'relevance']), default='title', show_default=True)
+@click.option('--after', default=None, help='Resume after the record with this cursor.')
+def export_books_command(export_format: str, output, use_gzip: bool, title: str, author: str, sort_by: str,
+                         after: str or None):
+    try:
+        after_key = decode_page_cursor(after) if after else None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--after')
+    records = export_records(author, title, sort_by, after_key)
+    chunks = buffered(to_csv(records) if export_format == 'csv' else to_ndjson(records))
+    for chunk in gzipped(chunks) if use_gzip else chunks:
+        output.write(chunk)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock, Thread
+
+from flask import Flask
+from werkzeug.datastructures import FileStorage
+
+from book_cafe.app_logger import logger
+from book_cafe.cover_store import normalize_cover, store_normalized_cover
+from book_cafe.db_objects import Book, db
+from book_cafe.exceptions import sql_alchemy_exception, Cover_Processing_Busy
+from configuration import COVER_PROCESSING_WORKERS, COVER_PROCESSING_MAX_PENDING, COVER_UPLOAD_CHUNK_BYTES
+
+
+class Cover_Processor:
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.slots = BoundedSemaphore(max_pending)
+        self.executor = None
+        self.executor_pid = None
+        self.lock = Lock()
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+                self.executor_pid = os.getpid()
+            return self.executor
+
+    def reserve(self):
+        if not self.workers or not self.slots.acquire(blocking=False): raise Cover_Processing_Busy()
+
+    def release(self):
+        self.slots.release()
+
+    def submit(self, app: Flask, book_id: int, data: bytes):
+        try:
+            future = self.get_executor().submit(normalize_cover, data)
+        except BaseException:
+            self.release()
+            raise
+        future.add_done_callback(lambda f: self.completed(app, book_id, f))
+
+    def completed(self, app: Flask, book_id: int, future: Future):
+        try:
+            normalized = future.result()
+            if not normalized: logger.info(f"Cover picture of book {book_id} rejected.")
+        except BrokenProcessPool:
+            with self.lock:
+                self.executor = None
+            logger.error(f"Cover processing pool broken, cover picture of book {book_id} dropped.")
+            normalized = None
+        except Exception as e:
+            logger.error(f"Cover picture of book {book_id} not processed: {e!r}")
+            normalized = None
+        if not normalized:
+            self.release()
+            return
+        Thread(target=self.finish, args=(app, book_id, normalized), daemon=True).start()
+
+    def finish(self, app: Flask, book_id: int, normalized: tuple[bytes, dict[str, bytes]]):
+        try:
+            cover_hash = store_normalized_cover(*normalized)
+            with app.app_context():
+                set_book_cover(book_id, cover_hash)
+        except Exception as e:
+            logger.error(f"Cover picture of book {book_id} not stored: {e!r}")
+        finally:
+            self.release()
+
+
+@sql_alchemy_exception()
+def set_book_cover(book_id: int, cover_hash: str):
+    Book.set_cover_hash(book_id, cover_hash)
+    db.session.commit()
+
+
+def read_upload(file: FileStorage, max_bytes: int) -> bytes or None:
+    if file.content_length and file.content_length > max_bytes: return None
+    chunks, size = [], 0
+    while chunk := file.stream.read(COVER_UPLOAD_CHUNK_BYTES):
+        size += len(chunk)
+        if size > max_bytes: return None
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+cover_processor = Cover_Processor(workers=COVER_PROCESSING_WORKERS, max_pending=COVER_PROCESSING_MAX_PENDING)
+
+
+if __name__ == "__main__":
+    pass
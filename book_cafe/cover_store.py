@@ -0,0 +1,103 @@
+import os
+from hashlib import sha256
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+
+from flask import Response, send_file
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from book_cafe.app_logger import logger
+from configuration import COVER_STORE_DIRECTORY, COVER_THUMBNAIL_SIZES, COVER_CACHE_MAX_AGE_SECONDS, COVER_MAX_DIMENSIONS, \
+    COVER_MAX_PIXELS, COVER_JPEG_QUALITY
+
+IMAGE_SIGNATURES = {b'\x89PNG\r\n\x1a\n': 'image/png', b'\xff\xd8\xff': 'image/jpeg'}
+
+
+def store_cover(data: bytes) -> str:
+    normalized = normalize_cover(data)
+    if normalized: return store_normalized_cover(*normalized)
+    logger.error("Cover picture could not be normalized, storing it unchanged.")
+    cover_hash = sha256(data).hexdigest()
+    if not os.path.exists(cover_path(cover_hash)):
+        write_file(cover_path(cover_hash), data)
+    return cover_hash
+
+
+def store_normalized_cover(cover: bytes, thumbnails: dict[str, bytes]) -> str:
+    cover_hash = sha256(cover).hexdigest()
+    if not os.path.exists(cover_path(cover_hash)):
+        write_file(cover_path(cover_hash), cover)
+    for size_name, thumbnail in thumbnails.items():
+        if not os.path.exists(cover_path(cover_hash, size_name)):
+            write_file(cover_path(cover_hash, size_name), thumbnail)
+    return cover_hash
+
+
+def normalize_cover(data: bytes) -> tuple[bytes, dict[str, bytes]] or None:
+    if not image_mimetype(data[:16]): return None
+    Image.MAX_IMAGE_PIXELS = COVER_MAX_PIXELS
+    try:
+        image = Image.open(BytesIO(data))
+        if image.format not in ('PNG', 'JPEG'): return None
+        image = flatten(ImageOps.exif_transpose(image))
+        image.thumbnail(COVER_MAX_DIMENSIONS)
+        thumbnails = dict()
+        for size_name, size in COVER_THUMBNAIL_SIZES.items():
+            thumbnail = image.copy()
+            thumbnail.thumbnail(size)
+            thumbnails[size_name] = encode_jpeg(thumbnail)
+        return encode_jpeg(image), thumbnails
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        return None
+
+
+def flatten(image: Image.Image) -> Image.Image:
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def encode_jpeg(image: Image.Image) -> bytes:
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=COVER_JPEG_QUALITY, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def image_mimetype(head: bytes) -> str or None:
+    for signature, mimetype in IMAGE_SIGNATURES.items():
+        if head.startswith(signature): return mimetype
+    return None
+
+
+def cover_path(cover_hash: str, size_name: str or None = None) -> str:
+    file_name = f'{cover_hash}_{size_name}' if size_name else cover_hash
+    return os.path.join(COVER_STORE_DIRECTORY, cover_hash[:2], file_name)
+
+
+def write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_file.name, path)
+
+
+def cover_mimetype(path: str) -> str:
+    with open(path, 'rb') as f:
+        return image_mimetype(f.read(16)) or 'application/octet-stream'
+
+
+def send_cover(cover_hash: str, size_name: str or None = None) -> Response or None:
+    path = cover_path(cover_hash, size_name)
+    if size_name and not os.path.exists(path):
+        path, size_name = cover_path(cover_hash), None
+    if not os.path.exists(path): return None
+    etag = f'{cover_hash}_{size_name}' if size_name else cover_hash
+    return send_file(os.path.abspath(path), mimetype=cover_mimetype(path), conditional=True, etag=etag,
+                     max_age=COVER_CACHE_MAX_AGE_SECONDS)
+
+
+if __name__ == "__main__":
+    pass
@@ -1,6 +1,18 @@
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from sqlalchemy import Row, update
+from sqlalchemy.exc import SQLAlchemyError
+
 from book_cafe.app_logger import logger
-from book_cafe.db_objects import User, Book, Role, Role_User, db
+from book_cafe.catalogue_replica import Catalogue_Snapshot, catalogue_replica
+from book_cafe.cover_store import store_cover
+from book_cafe.db_objects import User, Book, Role, Role_User, Author_Stats, db
+from book_cafe.db_routing import primary_read
 from book_cafe.exceptions import sql_alchemy_exception
+from book_cafe.search_cache import search_cache, search_cache_key, get_catalogue_generation
+from book_cafe.suggestions import SUGGESTION_KINDS, rebuild_suggestions
+from configuration import BOOK_PAGE_SIZE
 
 
 @sql_alchemy_exception()
@@ -20,15 +32,102 @@ def initialize_database():
             Role_User.add_new(role_id=admin_role.id, user_id=admin_user.id)
             logger.info(f"Database initialized - Admin role assigned to Admin.")
     else:
-        logger.info(f"Database initialized - Create Admin user and restart!")
+        logger.info(f"Database initialized - Create Admin user and run init-db again!")
+    Book.create_search_index()
+    if not Author_Stats.query.first():
+        Author_Stats.rebuild()
     db.session.commit()
 
 
 @sql_alchemy_exception()
-def query_books(author: str, title: str, sort_by: str) -> list[dict]:
-    books = Book.get_books_by_author_title(author=author, title=title, sort_by=sort_by)
-    books = [{'title': b.title, 'author': b.author, 'description': b.description[:100], 'book_id': b.id} for b in books]
-    return books
+def query_book_page(author: str, title: str, sort_by: str, cursor: str or None = None,
+                    replica: Catalogue_Snapshot or None = None) -> tuple[list[dict], str]:
+    after = decode_page_cursor(cursor) if cursor else None
+    replica = replica or catalogue_replica.get()
+    books = replica.page(author, title, sort_by, after=after, limit=BOOK_PAGE_SIZE + 1) if replica else None
+    if books is None:
+        books = Book.get_book_page(author=author, title=title, sort_by=sort_by, after=after, limit=BOOK_PAGE_SIZE + 1)
+        if books is None: return None
+    next_cursor = encode_page_cursor(books[BOOK_PAGE_SIZE - 1]) if len(books) > BOOK_PAGE_SIZE else None
+    books = [{'title': b.title, 'author': b.author, 'description': b.description, 'book_id': b.id,
+              'cover_hash': b.cover_hash} for b in books[:BOOK_PAGE_SIZE]]
+    return books, next_cursor
+
+
+@primary_read()
+def query_primary_book_page(author: str, title: str, sort_by: str, cursor: str or None) -> tuple[list[dict], str]:
+    return query_book_page(author, title, sort_by, cursor)
+
+
+def cached_query_book_page(author: str, title: str, sort_by: str, cursor: str or None = None) -> tuple[list[dict], str]:
+    replica = catalogue_replica.get()
+    generation = None if replica else get_catalogue_generation()
+    key = search_cache_key(generation, author, title, sort_by, cursor) if generation is not None else None
+    result = search_cache.get(key) if key else None
+    if result is None:
+        if key:
+            result = query_primary_book_page(author, title, sort_by, cursor)
+        else:
+            result = query_book_page(author, title, sort_by, cursor, replica=replica)
+        if result is None: return [], None
+        if key: search_cache.set(key, result)
+    books, next_cursor = result
+    return books, next_cursor
+
+
+@sql_alchemy_exception()
+def migrate_cover_pictures(batch_size: int) -> int:
+    migrated, after_id = 0, 0
+    while rows := Book.get_cover_blobs(after_id=after_id, limit=batch_size):
+        updates = [{'id': r.id, 'cover_hash': store_cover(r.cover_picture), 'cover_picture': None} for r in rows]
+        db.session.execute(update(Book), updates)
+        db.session.commit()
+        migrated += len(rows)
+        after_id = rows[-1].id
+        logger.info(f"{migrated} cover pictures moved to the cover store.")
+    return migrated
+
+
+@sql_alchemy_exception()
+def rebuild_suggestion_index(chunk_size: int) -> dict:
+    rebuilt = dict()
+    for kind in SUGGESTION_KINDS:
+        rebuilt[kind] = rebuild_suggestions(kind, Book.get_suggestion_counts(kind), chunk_size)
+        logger.info(f"Suggestion index rebuilt with {rebuilt[kind]} {kind}s.")
+    return rebuilt
+
+
+@sql_alchemy_exception()
+def rebuild_author_stats() -> int:
+    authors = Author_Stats.rebuild()
+    db.session.commit()
+    logger.info(f"Author statistics rebuilt with {authors} authors.")
+    return authors
+
+
+def apply_book_batch(delete_ids: list[int], changes: list[dict]) -> dict or None:
+    try:
+        deleted = Book.bulk_delete(delete_ids)
+        updated = Book.bulk_update(changes)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        logger.error("SQLAlchemyError - book batch rolled back.")
+        return None
+    logger.info(f"Book batch applied: {len(deleted)} deleted, {updated} updated.")
+    return {'deleted': len(deleted), 'updated': updated}
+
+
+def encode_page_cursor(book: Row) -> str:
+    return urlsafe_b64encode(json.dumps([book.sort_key, book.id]).encode()).decode()
+
+
+def decode_page_cursor(cursor: str) -> tuple:
+    try:
+        sort_key, book_id = json.loads(urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid page cursor {cursor}.")
+    return sort_key, int(book_id)
 
 
 if __name__ == "__main__":
@@ -1,20 +1,42 @@
+import csv
+from collections import Counter
 from datetime import datetime, timedelta
+from io import StringIO
+from typing import Iterable, Iterator
 
 from flask_security import UserMixin, RoleMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy.orm import relationship
-from werkzeug.security import generate_password_hash, check_password_hash
-
+from sqlalchemy import Column, Integer, MetaData, Row, String, Table, bindparam, delete, event, func, insert, literal, \
+    literal_column, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import DeclarativeBase, Query, Session
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy.sql.elements import ColumnElement
+
+from book_cafe.catalogue_feed import publish_catalogue_changes
+from book_cafe.db_routing import Routing_Session, replica_read
 from book_cafe.exceptions import sql_alchemy_exception
-from configuration import FAILED_LOGINS_WAIT_MINUTES, AUTOMATIC_LOGOUT_INACTIVITY_MINUTES
+from book_cafe.password_hashing import password_hasher, needs_rehash
+from book_cafe.principal import Principal, invalidate_principal
+from book_cafe.search_cache import bump_catalogue_generation
+from book_cafe.suggestions import update_suggestions
+from configuration import AUTOMATIC_LOGOUT_INACTIVITY_MINUTES, SEARCH_MIN_TERM_LENGTH, \
+    BOOK_PAGE_SIZE, BOOK_DESCRIPTION_PREVIEW_LENGTH, BOOK_EXPORT_CHUNK_SIZE, BOOK_BULK_CHUNK_SIZE, \
+    AUTHOR_PAGE_SIZE, CATALOGUE_REPLICA_ENABLED, CATALOGUE_REPLICA_LOAD_CHUNK_SIZE
 
 
 class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': Routing_Session})
+
+# full-text index of the book table used by sqlite (fts5 trigram), not part of db.metadata
+book_search = Table('book_search', MetaData(),
+                    Column('rowid', Integer, primary_key=True),
+                    Column('title', String),
+                    Column('author', String))
 
 
 class Role_User(db.Model):
@@ -30,6 +52,7 @@ class Role_User(db.Model):
     def add_new(role_id: int, user_id: int) -> "Role_User":
         new_role_user = Role_User(role_id=role_id, user_id=user_id)
         db.session.add(new_role_user)
+        User.mark_user_changed(user_id)
         return new_role_user
 
 
@@ -76,6 +99,7 @@ class User(UserMixin, db.Model):
 
     @staticmethod
     @sql_alchemy_exception()
+    @replica_read()
     def get_user_by_name(username: str) -> "User":
         user = User.query.filter(User.username == username).first()
         return user
@@ -88,29 +112,54 @@ class User(UserMixin, db.Model):
 
     @staticmethod
     @sql_alchemy_exception()
-    def get_users_with_failed_logins_to_reset() -> list["User"]:
-        older_than = datetime.now() - timedelta(minutes=FAILED_LOGINS_WAIT_MINUTES)
-        users = (User.query
-                 .filter((User.failed_login_attempts > 0) & (User.last_failed_login_attempt < older_than))
-                 .all())
-        return users
+    def get_principal(user_id: int) -> Principal or None:
+        rows = (db.session.query(User.id, User.username, User.is_logged_in, Role.name)
+                .outerjoin(Role_User, Role_User.user_id == User.id)
+                .outerjoin(Role, Role.id == Role_User.role_id)
+                .filter(User.id == user_id)
+                .all())
+        if not rows: return None
+        roles = frozenset(r.name for r in rows if r.name)
+        return Principal(rows[0].id, rows[0].username, rows[0].is_logged_in, roles)
+
+    @staticmethod
+    def mark_user_changed(user_id: int):
+        db.session.info.setdefault('changed_users', set()).add(user_id)
 
     @staticmethod
     @sql_alchemy_exception()
-    def get_inactive_users() -> list["User"]:
+    def logout_inactive_users_chunk(chunk_size: int, active_user_ids: list[int]) -> list[Row]:
         inactive_threshold = datetime.now() - timedelta(minutes=AUTOMATIC_LOGOUT_INACTIVITY_MINUTES)
-        users = (User.query
-                 .filter(User.is_logged_in & (User.last_activity < inactive_threshold))
-                 .all())
-        return users
+        chunk = (select(User.id)
+                 .where(User.is_logged_in & (User.last_activity < inactive_threshold)
+                        & User.id.not_in(active_user_ids))
+                 .limit(chunk_size))
+        rows = db.session.execute(update(User)
+                                  .where(User.id.in_(chunk.scalar_subquery()))
+                                  .values(is_logged_in=False)
+                                  .returning(User.id, User.username)
+                                  .execution_options(synchronize_session=False)).all()
+        for r in rows: User.mark_user_changed(r.id)
+        return rows
+
+    @staticmethod
+    @sql_alchemy_exception()
+    def update_last_activities(activities: dict[int, datetime]):
+        if not activities: return
+        db.session.execute(update(User), [{'id': user_id, 'last_activity': last_activity}
+                                          for user_id, last_activity in activities.items()])
 
     @sql_alchemy_exception()
     def set_password(self, p: str):
-        self.password = generate_password_hash(p)
+        self.password = password_hasher.hash(p)
 
     @sql_alchemy_exception()
     def check_password(self, p: str) -> bool:
-        return check_password_hash(self.password, p)
+        return password_hasher.verify(self.password, p)
+
+    @sql_alchemy_exception()
+    def password_needs_rehash(self) -> bool:
+        return needs_rehash(self.password)
 
     @sql_alchemy_exception()
     def get_id(self: "User") -> str:
@@ -123,8 +172,9 @@ class User(UserMixin, db.Model):
         return False
 
     @sql_alchemy_exception()
-    def reset_failed_login_attempts(self: "User"):
-        self.failed_login_attempts = 0
+    def set_logged_in(self: "User", is_logged_in: bool):
+        self.is_logged_in = is_logged_in
+        User.mark_user_changed(self.id)
 
 
 class Book(db.Model):
@@ -133,43 +183,340 @@ class Book(db.Model):
     title = db.Column(db.String(50), index=True, nullable=False)
     author = db.Column(db.String(50), index=True, nullable=False)
     description = db.Column(db.String(500), nullable=False)
-    cover_picture = db.Column(db.LargeBinary)
+    cover_picture = deferred(db.Column(db.LargeBinary))
+    cover_hash = db.Column(db.String(64))
     date_created = db.Column(db.DateTime, default=datetime.now(), nullable=False)
     user_created = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     __table_args__ = (db.Index('title_author_index', 'title', 'author'),)
 
     @staticmethod
     @sql_alchemy_exception()
-    def add_new(title: str, author: str, description: str, user_id: int, cover_picture: db.LargeBinary) -> "Book":
+    def add_new(title: str, author: str, description: str, user_id: int, cover_hash: str or None) -> "Book":
         new_book = Book(title=title, author=author, description=description, user_created=user_id,
-                        cover_picture=cover_picture)
+                        cover_hash=cover_hash)
         db.session.add(new_book)
+        db.session.flush()
+        new_book.add_to_search_index()
+        Book.mark_catalogue_changed()
+        Book.mark_suggestions_changed([(title, author)], 1)
+        Book.mark_replica_changed([new_book.id])
         return new_book
 
+    @staticmethod
+    def bulk_add_new(books: list[dict]):
+        if not books: return
+        if Book.search_dialect() == 'postgresql':
+            Book.copy_books(books)
+            Book.mark_replica_reload()
+        else:
+            rows = db.session.execute(insert(Book).returning(Book.id, Book.title, Book.author), books).all()
+            Book.add_rows_to_search_index(rows)
+            Book.mark_replica_changed(r.id for r in rows)
+        Book.mark_catalogue_changed()
+        Book.mark_suggestions_changed([(b['title'], b['author']) for b in books], 1)
+
+    @staticmethod
+    def copy_books(books: list[dict]):
+        columns = ['title', 'author', 'description', 'user_created', 'date_created']
+        statement = f"COPY book ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+        cursor = db.session.connection().connection.cursor()
+        if hasattr(cursor, 'copy_expert'):
+            buffer = StringIO()
+            csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows([b[c] for c in columns] for b in books)
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+        else:
+            with cursor.copy(statement) as copy:
+                for b in books: copy.write_row([b[c] for c in columns])
+
+    @staticmethod
+    def get_existing_title_authors(title_authors: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        if not title_authors: return set()
+        rows = (db.session.query(Book.title, Book.author)
+                .filter(tuple_(Book.title, Book.author).in_(title_authors))
+                .all())
+        return {(r.title, r.author) for r in rows}
+
     @staticmethod
     @sql_alchemy_exception()
-    def get_book_by_id(book_id: int) -> "Book":
-        book = (Book.query.filter(Book.id == book_id)).one()
-        return book
+    def get_cover_hash(book_id: int) -> str or None:
+        return db.session.query(Book.cover_hash).filter(Book.id == book_id).scalar()
+
+    @staticmethod
+    def set_cover_hash(book_id: int, cover_hash: str):
+        db.session.execute(update(Book).where(Book.id == book_id).values(cover_hash=cover_hash))
+        Book.mark_catalogue_changed()
+        Book.mark_replica_changed([book_id])
+
+    @staticmethod
+    @sql_alchemy_exception()
+    def get_cover_blobs(after_id: int, limit: int) -> list[Row]:
+        rows = (db.session.query(Book.id, Book.cover_picture)
+                .filter((Book.id > after_id) & Book.cover_picture.isnot(None))
+                .order_by(Book.id.asc())
+                .limit(limit)
+                .all())
+        return rows
 
     @staticmethod
     @sql_alchemy_exception()
     def get_books_by_author_title(author: str, title: str, sort_by: str = 'title') -> list["Book"]:
+        query, rank = Book.search(Book.query, author=author, title=title)
+        if sort_by == "author":
+            query = query.order_by(Book.author.asc(), Book.id.asc())
+        elif sort_by == "relevance":
+            query = query.order_by(rank.desc(), Book.id.asc())
+        else:
+            query = query.order_by(Book.title.asc(), Book.id.asc())
+        return query.all()
+
+    @staticmethod
+    @sql_alchemy_exception()
+    @replica_read()
+    def get_book_page(author: str, title: str, sort_by: str = 'title', after: tuple or None = None,
+                      limit: int or None = BOOK_PAGE_SIZE) -> list[Row]:
+        preview = func.substr(Book.description, 1, BOOK_DESCRIPTION_PREVIEW_LENGTH)
+        columns = [Book.id, Book.title, Book.author, preview.label('description'), Book.cover_hash]
+        query = Book.listing_query(columns, author=author, title=title, sort_by=sort_by, after=after)
+        if limit:
+            query = query.limit(limit)
+        return query.all()
+
+    @staticmethod
+    @replica_read()
+    def stream_books(author: str, title: str, sort_by: str = 'title', after: tuple or None = None) -> Iterator[Row]:
+        columns = [Book.id, Book.title, Book.author, Book.description]
+        query = Book.listing_query(columns, author=author, title=title, sort_by=sort_by, after=after)
+        return iter(query.yield_per(BOOK_EXPORT_CHUNK_SIZE))
+
+    @staticmethod
+    def listing_query(columns: list, author: str, title: str, sort_by: str, after: tuple or None) -> Query:
+        query, rank = Book.search(db.session.query(*columns), author=author, title=title)
         if sort_by == "author":
-            books = (Book.query
-                     .filter(Book.title.like(f'%{title}%') & Book.author.like(f'%{author}%'))
-                     .order_by(Book.author.asc())
-                     .all())
+            sort_key = Book.codepoint_order(Book.author)
+        elif sort_by == "relevance":
+            sort_key = -rank
         else:
-            books = (Book.query
-                     .filter(Book.title.like(f'%{title}%') & Book.author.like(f'%{author}%'))
-                     .order_by(Book.title.asc())
-                     .all())
-        return books
+            sort_key = Book.codepoint_order(Book.title)
+        query = query.add_columns(sort_key.label('sort_key'))
+        if after:
+            query = query.filter(tuple_(sort_key, Book.id) > tuple_(*after))
+        return query.order_by(sort_key.asc(), Book.id.asc())
+
+    @staticmethod
+    def codepoint_order(column: ColumnElement) -> ColumnElement:
+        if not CATALOGUE_REPLICA_ENABLED or Book.search_dialect() != 'postgresql': return column
+        return column.collate('C')
+
+    @staticmethod
+    def search(query: Query, author: str, title: str) -> tuple[Query, ColumnElement]:
+        terms = {'title': title or '', 'author': author or ''}
+        columns = {'title': Book.title, 'author': Book.author}
+        rank = literal(0.0)
+        if Book.search_dialect() == 'sqlite':
+            fts_terms = {c: t for c, t in terms.items() if len(t) >= SEARCH_MIN_TERM_LENGTH}
+            if fts_terms:
+                match = ' AND '.join(f'{c}: {Book.escape_fts(t)}' for c, t in fts_terms.items())
+                hits = (select(book_search.c.rowid.label('book_id'),
+                               func.bm25(literal_column('book_search')).label('score'))
+                        .where(text('book_search MATCH :match').bindparams(match=match))
+                        .subquery())
+                query = query.join(hits, hits.c.book_id == Book.id)
+                rank = -hits.c.score
+                terms = {c: t for c, t in terms.items() if c not in fts_terms}
+        for c, t in terms.items():
+            if not t: continue
+            query = query.filter(columns[c].ilike(f'%{Book.escape_like(t)}%', escape='\\'))
+            if Book.search_dialect() == 'postgresql':
+                rank = rank + func.similarity(columns[c], t)
+        return query, rank
+
+    @staticmethod
+    def escape_like(term: str) -> str:
+        return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
+    @staticmethod
+    def escape_fts(term: str) -> str:
+        return '"' + term.replace('"', '""') + '"'
+
+    @staticmethod
+    def search_dialect() -> str:
+        return db.engine.dialect.name
+
+    @staticmethod
+    @sql_alchemy_exception()
+    def create_search_index():
+        if Book.search_dialect() == 'postgresql':
+            db.session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            db.session.execute(text('CREATE INDEX IF NOT EXISTS book_title_trgm_index '
+                                    'ON book USING gin (title gin_trgm_ops)'))
+            db.session.execute(text('CREATE INDEX IF NOT EXISTS book_author_trgm_index '
+                                    'ON book USING gin (author gin_trgm_ops)'))
+            if CATALOGUE_REPLICA_ENABLED:
+                db.session.execute(text('CREATE INDEX IF NOT EXISTS book_title_order_index '
+                                        'ON book (title COLLATE "C", id)'))
+                db.session.execute(text('CREATE INDEX IF NOT EXISTS book_author_order_index '
+                                        'ON book (author COLLATE "C", id)'))
+        elif Book.search_dialect() == 'sqlite':
+            if db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'book_search'")).first():
+                return
+            db.session.execute(text("CREATE VIRTUAL TABLE book_search USING fts5(title, author, tokenize='trigram')"))
+            db.session.execute(text('INSERT INTO book_search(rowid, title, author) SELECT id, title, author FROM book'))
+
+    @sql_alchemy_exception()
+    def add_to_search_index(self: "Book"):
+        Book.add_rows_to_search_index([self])
+
+    @staticmethod
+    def add_rows_to_search_index(books: list):
+        if Book.search_dialect() != 'sqlite' or not books: return
+        db.session.execute(insert(book_search), [{'rowid': b.id, 'title': b.title, 'author': b.author} for b in books])
+
+    @staticmethod
+    def mark_catalogue_changed():
+        db.session.info['catalogue_changed'] = True
+
+    @staticmethod
+    def mark_suggestions_changed(title_authors: list[tuple[str, str]], delta: int):
+        changes = db.session.info.setdefault('suggestion_changes', Counter())
+        for title, author in title_authors:
+            changes[('title', title)] += delta
+            changes[('author', author)] += delta
+
+    @staticmethod
+    def mark_replica_changed(book_ids: Iterable[int]):
+        if not CATALOGUE_REPLICA_ENABLED: return
+        db.session.info.setdefault('replica_changes', set()).update(book_ids)
+
+    @staticmethod
+    def mark_replica_reload():
+        if not CATALOGUE_REPLICA_ENABLED: return
+        db.session.info['replica_reload'] = True
+
+    @staticmethod
+    def get_replica_rows(book_ids: list[int] or None = None) -> Iterator[Row]:
+        preview = func.substr(Book.description, 1, BOOK_DESCRIPTION_PREVIEW_LENGTH)
+        query = db.session.query(Book.id, Book.title, Book.author, preview.label('description'), Book.cover_hash)
+        if book_ids is not None:
+            query = query.filter(Book.id.in_(book_ids))
+        return iter(query.yield_per(CATALOGUE_REPLICA_LOAD_CHUNK_SIZE))
+
+    @staticmethod
+    def get_suggestion_counts(kind: str) -> Iterator[Row]:
+        column = Book.title if kind == 'title' else Book.author
+        return iter(db.session.query(column, func.count()).group_by(column).yield_per(BOOK_EXPORT_CHUNK_SIZE))
+
+    @staticmethod
+    def bulk_delete(book_ids: list[int]) -> list[Row]:
+        deleted = []
+        for chunk in Book.id_chunks(book_ids):
+            rows = db.session.execute(delete(Book)
+                                      .where(Book.id.in_(chunk))
+                                      .returning(Book.id, Book.title, Book.author)
+                                      .execution_options(synchronize_session=False)).all()
+            if Book.search_dialect() == 'sqlite' and rows:
+                db.session.execute(delete(book_search).where(book_search.c.rowid.in_([r.id for r in rows])))
+            deleted += rows
+        if deleted:
+            Book.mark_catalogue_changed()
+            Book.mark_suggestions_changed([(r.title, r.author) for r in deleted], -1)
+            Book.mark_replica_changed(r.id for r in deleted)
+        return deleted
+
+    @staticmethod
+    def bulk_update(changes: list[dict]) -> int:
+        updated = 0
+        for chunk in Book.id_chunks(changes):
+            old = {r.id: r for r in db.session.query(Book.id, Book.title, Book.author)
+                   .filter(Book.id.in_([c['id'] for c in chunk]))}
+            chunk = [c for c in chunk if c['id'] in old]
+            if not chunk: continue
+            db.session.execute(update(Book), chunk)
+            new = [{'id': c['id'], 'title': c.get('title', old[c['id']].title),
+                    'author': c.get('author', old[c['id']].author)} for c in chunk]
+            Book.mark_suggestions_changed([(old[n['id']].title, old[n['id']].author) for n in new], -1)
+            Book.mark_suggestions_changed([(n['title'], n['author']) for n in new], 1)
+            if Book.search_dialect() == 'sqlite':
+                db.session.execute(update(book_search)
+                                   .where(book_search.c.rowid == bindparam('book_id'))
+                                   .values(title=bindparam('new_title'), author=bindparam('new_author')),
+                                   [{'book_id': n['id'], 'new_title': n['title'], 'new_author': n['author']}
+                                    for n in new])
+            Book.mark_replica_changed(n['id'] for n in new)
+            updated += len(chunk)
+        if updated:
+            Book.mark_catalogue_changed()
+        return updated
+
+    @staticmethod
+    def id_chunks(items: list) -> Iterator[list]:
+        for i in range(0, len(items), BOOK_BULK_CHUNK_SIZE):
+            yield items[i:i + BOOK_BULK_CHUNK_SIZE]
+
+
+class Author_Stats(db.Model):
+    __tablename__ = 'author_stats'
+    author = db.Column(db.String(50), primary_key=True)
+    book_count = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    @sql_alchemy_exception()
+    @replica_read()
+    def get_page(start: str = '', limit: int = AUTHOR_PAGE_SIZE) -> list[Row]:
+        rows = (db.session.query(Author_Stats.author, Author_Stats.book_count)
+                .filter(Author_Stats.author >= start)
+                .order_by(Author_Stats.author.asc())
+                .limit(limit)
+                .all())
+        return rows
+
+    @staticmethod
+    def apply_changes(counts: dict[str, int]):
+        if not counts: return
+        rows = [{'author': a, 'book_count': c} for a, c in sorted(counts.items())]
+        upsert = postgresql_insert if Book.search_dialect() == 'postgresql' else sqlite_insert
+        statement = upsert(Author_Stats)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[Author_Stats.author],
+            set_={'book_count': Author_Stats.book_count + statement.excluded.book_count}), rows)
+        db.session.execute(delete(Author_Stats)
+                           .where(Author_Stats.author.in_(list(counts)) & (Author_Stats.book_count <= 0))
+                           .execution_options(synchronize_session=False))
+
+    @staticmethod
     @sql_alchemy_exception()
-    def delete(self: "Book"):
-        db.session.delete(self)
+    def rebuild() -> int:
+        db.session.execute(delete(Author_Stats))
+        db.session.execute(insert(Author_Stats).from_select(['author', 'book_count'],
+                                                            select(Book.author, func.count()).group_by(Book.author)))
+        return db.session.query(func.count()).select_from(Author_Stats).scalar()
+
+
+@event.listens_for(Session, 'before_commit')
+def update_author_stats_before_commit(session: Session):
+    suggestion_changes = session.info.get('suggestion_changes', Counter())
+    Author_Stats.apply_changes({display: delta for (kind, display), delta in suggestion_changes.items()
+                                if kind == 'author' and delta})
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_changes_after_commit(session: Session):
+    publish_catalogue_changes(session.info.pop('replica_changes', set()), session.info.pop('replica_reload', False))
+    if session.info.pop('catalogue_changed', False):
+        bump_catalogue_generation()
+    for user_id in session.info.pop('changed_users', set()):
+        invalidate_principal(user_id)
+    suggestion_changes = session.info.pop('suggestion_changes', Counter())
+    update_suggestions([(kind, display, delta) for (kind, display), delta in suggestion_changes.items() if delta])
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes_after_rollback(session: Session):
+    session.info.pop('catalogue_changed', None)
+    session.info.pop('changed_users', None)
+    session.info.pop('suggestion_changes', None)
+    session.info.pop('replica_changes', None)
+    session.info.pop('replica_reload', None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+import random
+import time
+from collections import Counter
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable
+
+from flask import current_app, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select, event
+
+from configuration import DB_POOL_SIZE, DB_POOL_MAX_OVERFLOW, DB_POOL_TIMEOUT_SECONDS, DB_POOL_PRE_PING, \
+    DB_POOL_RECYCLE_SECONDS, DB_REPLICA_STICKY_SECONDS
+
+REPLICA_BIND_PREFIX = 'replica_'
+replica_reads = ContextVar('replica_reads', default=False)
+primary_reads = ContextVar('primary_reads', default=False)
+routed_queries = Counter()
+
+
+class Routing_Session(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and replica_reads.get() and not primary_reads.get() and self.replica_allowed(clause):
+            replica_key = self.replica_key()
+            if replica_key:
+                routed_queries[replica_key] += 1
+                return self._db.engines[replica_key]
+        routed_queries['primary'] += 1
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def replica_allowed(self, clause) -> bool:
+        if clause is not None and not isinstance(clause, Select): return False
+        if self._flushing or self.new or self.dirty or self.deleted: return False
+        return time.time() >= primary_sticky_until(self)
+
+    def replica_key(self) -> str or None:
+        if 'replica_key' not in self.info:
+            keys = [k for k in self._db.engines if k and k.startswith(REPLICA_BIND_PREFIX)]
+            self.info['replica_key'] = random.choice(keys) if keys else None
+        return self.info['replica_key']
+
+
+def primary_sticky_until(db_session: Session) -> float:
+    sticky_until = db_session.info.get('primary_until', 0)
+    if has_request_context():
+        sticky_until = max(sticky_until, session.get('db_primary_until', 0))
+    return sticky_until
+
+
+@event.listens_for(Routing_Session, 'after_commit')
+def stick_to_primary_after_commit(db_session: Session):
+    if not db_session.info.pop('has_writes', False): return
+    sticky_until = time.time() + DB_REPLICA_STICKY_SECONDS
+    db_session.info['primary_until'] = sticky_until
+    if has_request_context():
+        session['db_primary_until'] = sticky_until
+
+
+@event.listens_for(Routing_Session, 'after_flush')
+def mark_session_writes(db_session: Session, flush_context):
+    db_session.info['has_writes'] = True
+
+
+@event.listens_for(Routing_Session, 'do_orm_execute')
+def mark_statement_writes(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info['has_writes'] = True
+
+
+def replica_read() -> Callable:
+    def decorator(f: Callable):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            token = replica_reads.set(True)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                replica_reads.reset(token)
+        return wrapped
+    return decorator
+
+
+def primary_read() -> Callable:
+    def decorator(f: Callable):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            token = primary_reads.set(True)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                primary_reads.reset(token)
+        return wrapped
+    return decorator
+
+
+def engine_options(url: str) -> dict:
+    options = {'pool_pre_ping': DB_POOL_PRE_PING, 'pool_recycle': DB_POOL_RECYCLE_SECONDS}
+    if not url.startswith('sqlite'):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT_SECONDS)
+    return options
+
+
+def replica_binds(urls: list[str]) -> dict:
+    return {f'{REPLICA_BIND_PREFIX}{i}': {'url': url, **engine_options(url)} for i, url in enumerate(urls)}
+
+
+def pool_metric_lines() -> list[str]:
+    lines = ['# HELP bookcafe_db_pool_connections Connections of the SQLAlchemy pools by state.',
+             '# TYPE bookcafe_db_pool_connections gauge']
+    for key, engine in current_app.extensions['sqlalchemy'].engines.items():
+        pool, bind = engine.pool, key or 'primary'
+        for state in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, state):
+                lines.append(f'bookcafe_db_pool_connections{{bind="{bind}",state="{state}"}} {getattr(pool, state)()}')
+    lines += ['# HELP bookcafe_db_routed_statements_total Statements routed to the primary or a replica.',
+              '# TYPE bookcafe_db_routed_statements_total counter']
+    lines += [f'bookcafe_db_routed_statements_total{{bind="{bind}"}} {count}'
+              for bind, count in sorted(routed_queries.items())]
+    return lines
+
+
+if __name__ == "__main__":
+    pass
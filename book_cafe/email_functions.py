@@ -1,20 +1,191 @@
+import json
 import smtplib
+import time
+from contextlib import contextmanager
 from email.mime.text import MIMEText
+from queue import LifoQueue, Empty, Full
+from uuid import uuid4
 
 from book_cafe.app_logger import logger
+from book_cafe.exceptions import reddis_exception
+from book_cafe.redis import redis_client
 from confidential import EMAIL_PASSWORD, EMAIL_SENDER
-from configuration import MAIL_SERVER_URL, MAIL_SERVER_PORT
+from configuration import MAIL_SERVER_URL, MAIL_SERVER_PORT, MAIL_SERVER_USE_SSL, MAIL_SERVER_LOGIN_REQUIRED, \
+    EMAIL_BATCH_SIZE, EMAIL_DIGEST_THRESHOLD, EMAIL_MAX_ATTEMPTS, EMAIL_RETRY_BASE_SECONDS, SMTP_POOL_SIZE, \
+    SMTP_CONNECTION_MAX_IDLE_SECONDS, SMTP_TIMEOUT_SECONDS
+from constants import REDIS_KEY_EMAIL_OUTBOX, REDIS_KEY_EMAIL_RETRY, REDIS_KEY_EMAIL_DEAD, REDIS_KEY_EMAIL_PROCESSING
 
 
-def send_email(mail_subject: str, mail_text: str, recipients: list[str]):
-    msg = MIMEText(mail_text)
-    msg['Subject'] = mail_subject
-    msg['From'] = EMAIL_SENDER
-    msg['To'] = ', '.join(recipients)
-    with smtplib.SMTP_SSL(MAIL_SERVER_URL, MAIL_SERVER_PORT) as smtp_server:
+class Smtp_Connection_Pool:
+    def __init__(self, size: int, max_idle_seconds: float):
+        self.connections = LifoQueue(maxsize=size)
+        self.max_idle_seconds = max_idle_seconds
+
+    @contextmanager
+    def connection(self):
+        smtp_server = self.checkout()
+        try:
+            yield smtp_server
+        except (smtplib.SMTPException, OSError):
+            close_quietly(smtp_server)
+            raise
+        self.checkin(smtp_server)
+
+    def checkout(self) -> smtplib.SMTP:
+        while True:
+            try:
+                smtp_server, last_used = self.connections.get_nowait()
+            except Empty:
+                return connect_smtp_server()
+            if time.monotonic() - last_used < self.max_idle_seconds and is_alive(smtp_server):
+                return smtp_server
+            close_quietly(smtp_server)
+
+    def checkin(self, smtp_server: smtplib.SMTP):
+        try:
+            self.connections.put_nowait((smtp_server, time.monotonic()))
+        except Full:
+            close_quietly(smtp_server)
+
+
+def connect_smtp_server() -> smtplib.SMTP:
+    if MAIL_SERVER_USE_SSL:
+        smtp_server = smtplib.SMTP_SSL(MAIL_SERVER_URL, MAIL_SERVER_PORT, timeout=SMTP_TIMEOUT_SECONDS)
+    else:
+        smtp_server = smtplib.SMTP(MAIL_SERVER_URL, MAIL_SERVER_PORT, timeout=SMTP_TIMEOUT_SECONDS)
+    if MAIL_SERVER_LOGIN_REQUIRED:
         smtp_server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-        smtp_server.sendmail(EMAIL_SENDER, recipients, msg.as_string())
-    logger.info(f"Email sent to {recipients}.")
+    return smtp_server
+
+
+def is_alive(smtp_server: smtplib.SMTP) -> bool:
+    try:
+        return smtp_server.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def close_quietly(smtp_server: smtplib.SMTP):
+    try:
+        smtp_server.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp_server.close()
+
+
+smtp_pool = Smtp_Connection_Pool(size=SMTP_POOL_SIZE, max_idle_seconds=SMTP_CONNECTION_MAX_IDLE_SECONDS)
+
+
+@reddis_exception()
+def send_email(mail_subject: str, mail_text: str, recipients: list[str], digest: bool = False):
+    message = {'id': uuid4().hex, 'subject': mail_subject, 'text': mail_text, 'recipients': recipients,
+               'digest': digest, 'attempts': 0}
+    redis_client.lpush(REDIS_KEY_EMAIL_OUTBOX, json.dumps(message))
+
+
+def deliver_email(smtp_server: smtplib.SMTP, message: dict):
+    msg = MIMEText(message['text'])
+    msg['Subject'] = message['subject']
+    msg['From'] = EMAIL_SENDER
+    msg['To'] = ', '.join(message['recipients'])
+    smtp_server.sendmail(EMAIL_SENDER, message['recipients'], msg.as_string())
+
+
+PROMOTE_DUE_RETRIES_SCRIPT = """
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('zrem', KEYS[1], unpack(due))
+    redis.call('lpush', KEYS[2], unpack(due))
+end
+return #due
+"""
+REQUEUE_PROCESSING_SCRIPT = """
+local moved = 0
+while redis.call('lmove', KEYS[1], KEYS[2], 'LEFT', 'RIGHT') do moved = moved + 1 end
+return moved
+"""
+recover_processing = True
+
+
+def coalesce_digests(messages: list[tuple[str, dict]]) -> list[tuple[list[str], dict]]:
+    digests, coalesced = dict(), []
+    for raw, m in messages:
+        if m.get('digest') and m['attempts'] == 0:
+            digests.setdefault(tuple(m['recipients']), []).append((raw, m))
+        else:
+            coalesced.append(([raw], m))
+    for recipients, group in digests.items():
+        if len(group) < EMAIL_DIGEST_THRESHOLD:
+            coalesced.extend(([raw], m) for raw, m in group)
+            continue
+        text = '\n'.join(f"{m['subject']}: {m['text']}" for raw, m in group)
+        coalesced.append(([raw for raw, m in group],
+                          {'id': uuid4().hex, 'subject': f'{len(group)} notifications', 'text': text,
+                           'recipients': list(recipients), 'digest': True, 'attempts': 0}))
+    return coalesced
+
+
+@reddis_exception()
+def requeue_processing() -> int:
+    moved = redis_client.eval(REQUEUE_PROCESSING_SCRIPT, 2, REDIS_KEY_EMAIL_PROCESSING, REDIS_KEY_EMAIL_OUTBOX)
+    if moved: logger.warning(f"{moved} unfinished emails queued again.")
+    return int(moved)
+
+
+@reddis_exception()
+def fetch_email_batch() -> list[tuple[str, dict]]:
+    redis_client.eval(PROMOTE_DUE_RETRIES_SCRIPT, 2, REDIS_KEY_EMAIL_RETRY, REDIS_KEY_EMAIL_OUTBOX, time.time(),
+                      EMAIL_BATCH_SIZE)
+    pipeline = redis_client.pipeline(transaction=False)
+    for _ in range(EMAIL_BATCH_SIZE):
+        pipeline.lmove(REDIS_KEY_EMAIL_OUTBOX, REDIS_KEY_EMAIL_PROCESSING, 'RIGHT', 'LEFT')
+    return [(raw, json.loads(raw)) for raw in pipeline.execute() if raw]
+
+
+@reddis_exception()
+def acknowledge(raws: list[str]) -> bool:
+    pipeline = redis_client.pipeline(transaction=True)
+    for raw in raws: pipeline.lrem(REDIS_KEY_EMAIL_PROCESSING, 1, raw)
+    pipeline.execute()
+    return True
+
+
+@reddis_exception()
+def schedule_retry(raws: list[str], message: dict) -> bool:
+    message = dict(message, attempts=message['attempts'] + 1)
+    pipeline = redis_client.pipeline(transaction=True)
+    if message['attempts'] >= EMAIL_MAX_ATTEMPTS:
+        logger.error(f"Email to {message['recipients']} dropped after {message['attempts']} attempts.")
+        pipeline.lpush(REDIS_KEY_EMAIL_DEAD, json.dumps(message))
+    else:
+        retry_at = time.time() + EMAIL_RETRY_BASE_SECONDS * 2 ** (message['attempts'] - 1)
+        pipeline.zadd(REDIS_KEY_EMAIL_RETRY, {json.dumps(message): retry_at})
+    for raw in raws: pipeline.lrem(REDIS_KEY_EMAIL_PROCESSING, 1, raw)
+    pipeline.execute()
+    return True
+
+
+def deliver_emails() -> int:
+    global recover_processing
+    if recover_processing and requeue_processing() is not None:
+        recover_processing = False
+    messages = coalesce_digests(fetch_email_batch() or [])
+    delivered = 0
+    for i, (raws, message) in enumerate(messages):
+        try:
+            with smtp_pool.connection() as smtp_server:
+                deliver_email(smtp_server, message)
+            delivered += 1
+            if not acknowledge(raws): recover_processing = True
+        except (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected, smtplib.SMTPAuthenticationError, OSError):
+            logger.error("Mail server not available.")
+            for raws_left, m in messages[i:]:
+                if not schedule_retry(raws_left, m): recover_processing = True
+            break
+        except smtplib.SMTPException:
+            logger.error(f"Email to {message['recipients']} could not be sent.")
+            if not schedule_retry(raws, message): recover_processing = True
+    if delivered: logger.info(f"{delivered} emails sent.")
+    return delivered
 
 
 if __name__ == "__main__":
@@ -1,12 +1,24 @@
 from functools import wraps
 from typing import Callable
 
-from redis.exceptions import RedisError
+from redis.exceptions import RedisError, ConnectionError
 from sqlalchemy.exc import SQLAlchemyError
 
 from book_cafe.app_logger import logger
 
 
+class Hashing_Service_Busy(Exception):
+    pass
+
+
+class Cover_Processing_Busy(Exception):
+    pass
+
+
+class Redis_Circuit_Open(ConnectionError):
+    pass
+
+
 def sql_alchemy_exception() -> Callable:
     def decorator(f: Callable):
         @wraps(f)
@@ -25,6 +37,8 @@ def reddis_exception() -> Callable:
         def wrapped(*args, **kwargs):
             try:
                 return f(*args, **kwargs)
+            except Redis_Circuit_Open:
+                return None
             except RedisError:
                 logger.error("RedisError")
         return wrapped
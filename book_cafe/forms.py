@@ -5,6 +5,7 @@ from wtforms import RadioField, TextAreaField
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import InputRequired, ValidationError
 
+from book_cafe.cover_store import image_mimetype
 from configuration import ALLOWED_PICTURE_FILE_EXTENSIONS
 
 
@@ -29,6 +30,12 @@ class Add_Book_Form(FlaskForm):
             message = 'Wrong file format.'
             flash(message)
             raise ValidationError(message)
+        head = file.data.stream.read(16)
+        file.data.stream.seek(0)
+        if not image_mimetype(head):
+            message = 'File is not a png or jpg image.'
+            flash(message)
+            raise ValidationError(message)
 
     title = StringField('Title', validators=[InputRequired('title required')])
     author = StringField('Author', validators=[InputRequired('author required')])
@@ -40,9 +47,17 @@ class Add_Book_Form(FlaskForm):
 class Find_Book_Form(FlaskForm):
     title = StringField('Title')
     author = StringField('Author')
-    sort_by = RadioField('Sort by', choices=[('title', 'title'), ('author', 'author')], default='title')
+    sort_by = RadioField('Sort by', choices=[('title', 'title'), ('author', 'author'), ('relevance', 'relevance')], default='title')
     submit = SubmitField('Submit')
 
 
+class Bulk_Book_Form(FlaskForm):
+    title = StringField('New title')
+    author = StringField('New author')
+    description = TextAreaField('New description')
+    edit = SubmitField('Edit selected')
+    delete = SubmitField('Delete selected')
+
+
 if __name__ == "__main__":
     pass
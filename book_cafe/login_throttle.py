@@ -0,0 +1,85 @@
+import time
+from threading import Lock
+from uuid import uuid4
+
+from book_cafe.exceptions import reddis_exception
+from book_cafe.redis import redis_client
+from configuration import MAX_FAILED_LOGIN_ATTEMPTS, MAX_FAILED_LOGIN_ATTEMPTS_PER_IP, FAILED_LOGINS_WAIT_MINUTES
+from constants import REDIS_KEY_LOGIN_FAILURES
+
+WINDOW_MILLISECONDS = FAILED_LOGINS_WAIT_MINUTES * 60 * 1000
+
+local_failures = dict()
+local_failures_lock = Lock()
+
+
+def user_failures_key(username: str) -> str:
+    return f'{REDIS_KEY_LOGIN_FAILURES}:user:{username}'
+
+
+def ip_failures_key(ip: str) -> str:
+    return f'{REDIS_KEY_LOGIN_FAILURES}:ip:{ip}'
+
+
+def is_login_throttled(username: str, ip: str) -> bool:
+    limits = {user_failures_key(username): MAX_FAILED_LOGIN_ATTEMPTS, ip_failures_key(ip): MAX_FAILED_LOGIN_ATTEMPTS_PER_IP}
+    counts = count_failures(list(limits))
+    if counts is None: counts = count_local_failures(list(limits))
+    return any(count >= limit for count, limit in zip(counts, limits.values()))
+
+
+def record_failed_login(username: str or None, ip: str):
+    keys = [user_failures_key(username), ip_failures_key(ip)] if username else [ip_failures_key(ip)]
+    if store_failure(keys) is None: store_local_failure(keys)
+
+
+def clear_failed_logins(username: str):
+    with local_failures_lock:
+        local_failures.pop(user_failures_key(username), None)
+    delete_failures(user_failures_key(username))
+
+
+@reddis_exception()
+def count_failures(keys: list[str]) -> list[int]:
+    now = int(time.time() * 1000)
+    pipeline = redis_client.pipeline()
+    for key in keys:
+        pipeline.zremrangebyscore(key, '-inf', now - WINDOW_MILLISECONDS)
+        pipeline.zcard(key)
+    return pipeline.execute()[1::2]
+
+
+@reddis_exception()
+def store_failure(keys: list[str]) -> bool:
+    now = int(time.time() * 1000)
+    pipeline = redis_client.pipeline()
+    for key in keys:
+        pipeline.zadd(key, {f'{now}:{uuid4().hex[:8]}': now})
+        pipeline.pexpire(key, WINDOW_MILLISECONDS)
+    pipeline.execute()
+    return True
+
+
+@reddis_exception()
+def delete_failures(key: str):
+    redis_client.delete(key)
+
+
+def count_local_failures(keys: list[str]) -> list[int]:
+    window_start = int(time.time() * 1000) - WINDOW_MILLISECONDS
+    with local_failures_lock:
+        return [sum(1 for timestamp in local_failures.get(key, ()) if timestamp > window_start) for key in keys]
+
+
+def store_local_failure(keys: list[str]):
+    now = int(time.time() * 1000)
+    with local_failures_lock:
+        for key in list(local_failures):
+            local_failures[key] = [t for t in local_failures[key] if t > now - WINDOW_MILLISECONDS]
+            if not local_failures[key]: del local_failures[key]
+        for key in keys:
+            local_failures.setdefault(key, []).append(now)
+
+
+if __name__ == "__main__":
+    pass
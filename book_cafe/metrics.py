@@ -0,0 +1,181 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable
+
+from flask import Flask, Response, g, has_request_context, request, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from book_cafe.app_logger import logger, logging_stats
+from configuration import METRICS_LATENCY_BUCKETS_SECONDS, METRICS_COUNT_BUCKETS, METRICS_ALLOWED_IPS, \
+    SLOW_REQUEST_LOG_MILLISECONDS, SLOW_REQUEST_MAX_LOGGED_QUERIES
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: tuple, buckets: list):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = sorted(buckets)
+        self.series = dict()
+        self.lock = Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.series.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self.series[label_values] = (counts, total + value)
+
+    def expose(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self.series.items()}
+        for label_values, (counts, total) in sorted(series.items()):
+            labels = [f'{name}="{escape_label(value)}"' for name, value in zip(self.label_names, label_values)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                bucket_labels = ','.join(labels + [f'le="{bound}"'])
+                lines.append(f'{self.name}_bucket{{{bucket_labels}}} {cumulative}')
+            suffix = '{' + ','.join(labels) + '}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return lines
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_duration = Histogram('bookcafe_request_duration_seconds', 'Time spent handling a request.',
+                             ('route', 'method', 'status'), METRICS_LATENCY_BUCKETS_SECONDS)
+request_db_queries = Histogram('bookcafe_request_db_queries', 'SQL statements executed per request.',
+                               ('route',), METRICS_COUNT_BUCKETS)
+request_db_duration = Histogram('bookcafe_request_db_seconds', 'Time spent in SQL statements per request.',
+                                ('route',), METRICS_LATENCY_BUCKETS_SECONDS)
+request_redis_calls = Histogram('bookcafe_request_redis_calls', 'Redis calls per request.',
+                                ('route',), METRICS_COUNT_BUCKETS)
+db_query_duration = Histogram('bookcafe_db_query_duration_seconds', 'Duration of single SQL statements.',
+                              (), METRICS_LATENCY_BUCKETS_SECONDS)
+redis_call_duration = Histogram('bookcafe_redis_call_duration_seconds', 'Duration of single Redis calls.',
+                                ('command',), METRICS_LATENCY_BUCKETS_SECONDS)
+template_render_duration = Histogram('bookcafe_template_render_seconds', 'Time spent rendering templates.',
+                                     ('template',), METRICS_LATENCY_BUCKETS_SECONDS)
+histograms = [request_duration, request_db_queries, request_db_duration, request_redis_calls, db_query_duration,
+              redis_call_duration, template_render_duration]
+metric_providers = []
+
+
+class Request_Metrics:
+    __slots__ = ('started', 'db_queries', 'db_seconds', 'redis_calls', 'redis_seconds', 'render_seconds',
+                 'statements')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.redis_calls = 0
+        self.redis_seconds = 0.0
+        self.render_seconds = 0.0
+        self.statements = [] if SLOW_REQUEST_LOG_MILLISECONDS is not None else None
+
+
+def current_request_metrics() -> Request_Metrics or None:
+    if not has_request_context(): return None
+    return g.get('request_metrics')
+
+
+def route_label() -> str:
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    db_query_duration.observe(elapsed)
+    metrics = current_request_metrics()
+    if not metrics: return
+    metrics.db_queries += 1
+    metrics.db_seconds += elapsed
+    if metrics.statements is not None and len(metrics.statements) < SLOW_REQUEST_MAX_LOGGED_QUERIES:
+        metrics.statements.append(f'{elapsed * 1000:.1f} ms | {" ".join(statement.split())}')
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(context):
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+def record_redis_call(command: str, elapsed: float):
+    redis_call_duration.observe(elapsed, command)
+    metrics = current_request_metrics()
+    if not metrics: return
+    metrics.redis_calls += 1
+    metrics.redis_seconds += elapsed
+
+
+def record_render(template: str, elapsed: float):
+    template_render_duration.observe(elapsed, template)
+    metrics = current_request_metrics()
+    if metrics:
+        metrics.render_seconds += elapsed
+
+
+def start_request_metrics():
+    g.request_metrics = Request_Metrics()
+
+
+def finish_request_metrics(response: Response) -> Response:
+    metrics = current_request_metrics()
+    if not metrics: return response
+    elapsed = time.perf_counter() - metrics.started
+    route = route_label()
+    request_duration.observe(elapsed, route, request.method, response.status_code)
+    request_db_queries.observe(metrics.db_queries, route)
+    request_db_duration.observe(metrics.db_seconds, route)
+    request_redis_calls.observe(metrics.redis_calls, route)
+    if SLOW_REQUEST_LOG_MILLISECONDS is not None and elapsed * 1000 >= SLOW_REQUEST_LOG_MILLISECONDS:
+        queries = ''.join(f'\n    {s}' for s in metrics.statements)
+        logger.warning(f"Slow request {request.method} {request.path}: {elapsed * 1000:.1f} ms, "
+                       f"{metrics.db_queries} queries in {metrics.db_seconds * 1000:.1f} ms, "
+                       f"{metrics.redis_calls} redis calls in {metrics.redis_seconds * 1000:.1f} ms, "
+                       f"rendering {metrics.render_seconds * 1000:.1f} ms.{queries}")
+    return response
+
+
+def expose_metrics() -> Response:
+    if request.remote_addr not in METRICS_ALLOWED_IPS:
+        abort(403)
+    lines = []
+    for histogram in histograms:
+        lines += histogram.expose()
+    lines += ['# HELP bookcafe_log_records_dropped_total Log records dropped because the log queue was full.',
+              '# TYPE bookcafe_log_records_dropped_total counter']
+    lines += [f'bookcafe_log_records_dropped_total{{level="{level}"}} {count}'
+              for level, count in sorted(logging_stats()['dropped'].items())]
+    for provider in metric_providers:
+        lines += provider()
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def register_metric_provider(provider: Callable[[], list[str]]):
+    if provider not in metric_providers:
+        metric_providers.append(provider)
+
+
+def init_metrics(app: Flask):
+    app.before_request(start_request_metrics)
+    app.after_request(finish_request_metrics)
+    app.add_url_rule('/metrics', 'metrics', expose_metrics)
+
+
+if __name__ == "__main__":
+    pass
@@ -1,45 +1,142 @@
 import time
+from collections import deque
 from datetime import datetime
+from threading import Condition, Thread
 
-from flask import render_template, Blueprint, Response
+from flask import render_template, Blueprint, Response, request
 from flask_login import current_user
+from redis.exceptions import RedisError
 
+from book_cafe.app_logger import logger
 from book_cafe.exceptions import reddis_exception
+from book_cafe.metrics import record_render
 from book_cafe.redis import redis_client
-from constants import REDIS_KEY_NAVBAR_NEWS, REDIS_KEY_NAVBAR_NEWS_DATE
+from configuration import NAVBAR_NEWS_HISTORY_LENGTH, NAVBAR_STREAM_HEARTBEAT_SECONDS, NAVBAR_STREAM_BLOCK_MILLISECONDS
+from constants import REDIS_KEY_NAVBAR_NEWS, REDIS_KEY_NAVBAR_NEWS_DATE, REDIS_KEY_NAVBAR_NEWS_STREAM
 
 
-@reddis_exception()
 def render_template_navbar(template: str, **context) -> str:
     if not context: context = dict()
     if current_user and hasattr(current_user, 'username'):
         context['navbar_info'] = f'You are logged in as {current_user.username}.'
     else:
         context['navbar_info'] = 'You are not logged in'
-    return render_template(template, **context)
+    started = time.perf_counter()
+    rendered = render_template(template, **context)
+    record_render(template, time.perf_counter() - started)
+    return rendered
+
+
+def stream_id_key(event_id: str) -> tuple[int, int]:
+    try:
+        milliseconds, sequence = event_id.split('-')
+        return int(milliseconds), int(sequence)
+    except (AttributeError, ValueError):
+        return 0, 0
+
+
+class News_Broadcaster:
+    def __init__(self, history_length: int):
+        self.history = deque(maxlen=history_length)
+        self.condition = Condition()
+        self.local_sequence = 0
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread and self.thread.is_alive(): return
+            self.thread = Thread(target=self.run, name='navbar_news_broadcaster', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        last_id = None
+        while True:
+            try:
+                if last_id is None:
+                    history = redis_client.xrevrange(REDIS_KEY_NAVBAR_NEWS_STREAM, count=self.history.maxlen)
+                    self.publish(reversed(history))
+                    last_id = history[0][0] if history else '0-0'
+                streams = redis_client.blocking_client.xread({REDIS_KEY_NAVBAR_NEWS_STREAM: last_id},
+                                                             block=NAVBAR_STREAM_BLOCK_MILLISECONDS)
+                for _, entries in streams or []:
+                    self.publish(entries)
+                    last_id = entries[-1][0]
+            except RedisError:
+                logger.error("RedisError")
+                time.sleep(NAVBAR_STREAM_HEARTBEAT_SECONDS)
+
+    def publish(self, entries):
+        with self.condition:
+            self.history.extend((event_id, fields.get('news', '')) for event_id, fields in entries)
+            self.condition.notify_all()
+
+    def publish_local(self, news: str):
+        with self.condition:
+            self.local_sequence += 1
+            event_id = f'{int(time.time() * 1000)}-{self.local_sequence}'
+        self.publish([(event_id, {'news': news})])
 
+    def events_after(self, event_id: str or None) -> list[tuple[str, str]]:
+        with self.condition:
+            if event_id is None: return list(self.history)[-1:]
+            return [e for e in self.history if stream_id_key(e[0]) > stream_id_key(event_id)]
+
+    def wait_for_events(self, event_id: str or None, timeout: float) -> list[tuple[str, str]]:
+        with self.condition:
+            events = self.events_after(event_id)
+            if not events:
+                self.condition.wait(timeout)
+                events = self.events_after(event_id)
+        return events
+
+    @property
+    def latest_news(self) -> str:
+        with self.condition:
+            return self.history[-1][1] if self.history else ''
+
+
+news_broadcaster = News_Broadcaster(history_length=NAVBAR_NEWS_HISTORY_LENGTH)
 
 navbar_news_stream = Blueprint('navbar_stream', __name__, template_folder='templates')
 
 
 @navbar_news_stream.route('/navbar_stream')
-@reddis_exception()
 def stream_navbar_news():
-    def event_stream():
+    news_broadcaster.start()
+    last_event_id = request.headers.get('Last-Event-ID')
+
+    def event_stream(event_id: str or None):
         monkeys = ['🍅', '🥦']
         i = 0
+        events = news_broadcaster.events_after(event_id)
         while True:
-            news = redis_client.get(REDIS_KEY_NAVBAR_NEWS)
-            yield "data:" + f"[{news}] " + monkeys[i] + "\n\n"
+            for event_id, news in events:
+                yield f"id:{event_id}\n" + "data:" + f"[{news}] " + monkeys[i] + "\n\n"
+            if not events:
+                yield "data:" + f"[{news_broadcaster.latest_news}] " + monkeys[i] + "\n\n"
             i = 1 if i == 0 else 0
-            time.sleep(5)
-    return Response(event_stream(), mimetype='text/event-stream')
+            events = news_broadcaster.wait_for_events(event_id, timeout=NAVBAR_STREAM_HEARTBEAT_SECONDS)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(event_stream(last_event_id), mimetype='text/event-stream', headers=headers)
 
 
-@reddis_exception()
 def set_navbar_news(news):
-    redis_client.set(REDIS_KEY_NAVBAR_NEWS, news)
-    redis_client.set(REDIS_KEY_NAVBAR_NEWS_DATE, str(datetime.now()))
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.set(REDIS_KEY_NAVBAR_NEWS, news)
+    pipeline.set(REDIS_KEY_NAVBAR_NEWS_DATE, str(datetime.now()))
+    pipeline.xadd(REDIS_KEY_NAVBAR_NEWS_STREAM, {'news': news}, maxlen=NAVBAR_NEWS_HISTORY_LENGTH, approximate=True)
+    try:
+        pipeline.execute()
+    except RedisError:
+        news_broadcaster.publish_local(news)
+
+
+@reddis_exception()
+def clear_navbar_news():
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.set(REDIS_KEY_NAVBAR_NEWS, '')
+    pipeline.xadd(REDIS_KEY_NAVBAR_NEWS_STREAM, {'news': ''}, maxlen=NAVBAR_NEWS_HISTORY_LENGTH, approximate=True)
+    pipeline.execute()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import sha1
+from threading import Lock
+
+from flask import Response, request, session, current_app
+from flask_login import current_user
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+
+from book_cafe.search_cache import get_catalogue_version
+from configuration import BOOK_CARD_CACHE_SIZE, LISTING_VALIDATOR_MAX_AGE_SECONDS
+
+
+class Fragment_Cache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.fragments = OrderedDict()
+        self.lock = Lock()
+
+    def get_or_render(self, key: str, render) -> Markup:
+        with self.lock:
+            if key in self.fragments:
+                self.fragments.move_to_end(key)
+                return self.fragments[key]
+        fragment = Markup(render())
+        with self.lock:
+            self.fragments[key] = fragment
+            while len(self.fragments) > self.max_size:
+                self.fragments.popitem(last=False)
+        return fragment
+
+
+book_card_cache = Fragment_Cache(max_size=BOOK_CARD_CACHE_SIZE)
+
+
+def render_book_card(book: dict) -> Markup:
+    version = sha1(json.dumps([book['title'], book['author'], book['description'], book['cover_hash']])
+                   .encode()).hexdigest()
+    return book_card_cache.get_or_render(
+        f"{book['book_id']}:{version}",
+        lambda: current_app.jinja_env.get_template('book_card.html').render(book=book))
+
+
+def listing_validators(*query) -> tuple[str, datetime] or tuple[None, None]:
+    version = get_catalogue_version()
+    if version is None: return None, None
+    generation, modified = version
+    user_id = current_user.get_id() if current_user else None
+    roles = sorted(getattr(current_user, 'roles', None) or ())
+    time_bucket = int(time.time() // LISTING_VALIDATOR_MAX_AGE_SECONDS)
+    validator = json.dumps([generation, user_id, roles, session.get('csrf_token'), time_bucket, *query])
+    return sha1(validator.encode()).hexdigest(), modified
+
+
+def listing_not_modified(etag: str or None) -> bool:
+    if not etag or session.get('_flashes'): return False
+    return not is_resource_modified(request.environ, etag=etag)
+
+
+def not_modified_response(etag: str, modified: datetime or None) -> Response:
+    return add_validators(Response(status=304), etag, modified)
+
+
+def add_validators(response: Response, etag: str or None, modified: datetime or None) -> Response:
+    if not etag: return response
+    response.set_etag(etag)
+    if modified:
+        response.last_modified = modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+if __name__ == "__main__":
+    pass
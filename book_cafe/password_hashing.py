@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+from typing import Callable
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from book_cafe.exceptions import Hashing_Service_Busy
+from configuration import PASSWORD_HASH_METHOD, PASSWORD_HASHING_WORKERS, PASSWORD_HASHING_MAX_PENDING, \
+    PASSWORD_HASHING_TIMEOUT_SECONDS
+
+
+class Password_Hasher:
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.slots = BoundedSemaphore(max_pending)
+        self.executor = None
+        self.executor_pid = None
+        self.lock = Lock()
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+                self.executor_pid = os.getpid()
+            return self.executor
+
+    def run(self, function: Callable, *args):
+        if not self.workers: return function(*args)
+        if not self.slots.acquire(blocking=False): raise Hashing_Service_Busy()
+        try:
+            future = self.get_executor().submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=PASSWORD_HASHING_TIMEOUT_SECONDS)
+        except TimeoutError:
+            raise Hashing_Service_Busy()
+        except BrokenProcessPool:
+            with self.lock:
+                self.executor = None
+            raise Hashing_Service_Busy()
+
+    def hash(self, password: str) -> str:
+        return self.run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self.run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    return password_hash.split('$', 1)[0] != PASSWORD_HASH_METHOD
+
+
+password_hasher = Password_Hasher(workers=PASSWORD_HASHING_WORKERS, max_pending=PASSWORD_HASHING_MAX_PENDING)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,86 @@
+import json
+import time
+from threading import Lock
+from typing import NamedTuple
+
+from book_cafe.exceptions import reddis_exception
+from book_cafe.redis import redis_client
+from configuration import PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_LOCAL_CACHE_TTL_SECONDS
+from constants import REDIS_KEY_PRINCIPAL
+
+
+class Principal(NamedTuple):
+    id: int
+    username: str
+    is_logged_in: bool
+    roles: frozenset[str]
+
+    @property
+    def is_authenticated(self) -> bool:
+        return True
+
+    @property
+    def is_active(self) -> bool:
+        return True
+
+    @property
+    def is_anonymous(self) -> bool:
+        return False
+
+    def get_id(self) -> str:
+        return str(self.id)
+
+    def has_role(self, required_role: str) -> bool:
+        return required_role in self.roles
+
+
+local_principals = dict()
+local_principals_lock = Lock()
+
+
+def get_cached_principal(user_id: int) -> Principal or None:
+    with local_principals_lock:
+        expires, principal = local_principals.get(user_id, (0, None))
+    if expires > time.monotonic(): return principal
+    principal = get_redis_principal(user_id)
+    if principal: set_local_principal(principal)
+    return principal
+
+
+def cache_principal(principal: Principal):
+    set_local_principal(principal)
+    set_redis_principal(principal)
+
+
+def set_local_principal(principal: Principal):
+    with local_principals_lock:
+        local_principals[principal.id] = (time.monotonic() + PRINCIPAL_LOCAL_CACHE_TTL_SECONDS, principal)
+
+
+def invalidate_principal(user_id: int):
+    with local_principals_lock:
+        local_principals.pop(user_id, None)
+    delete_redis_principal(user_id)
+
+
+@reddis_exception()
+def get_redis_principal(user_id: int) -> Principal or None:
+    value = redis_client.get(f'{REDIS_KEY_PRINCIPAL}:{user_id}')
+    if not value: return None
+    user_id, username, is_logged_in, roles = json.loads(value)
+    return Principal(user_id, username, is_logged_in, frozenset(roles))
+
+
+@reddis_exception()
+def set_redis_principal(principal: Principal):
+    value = json.dumps([principal.id, principal.username, principal.is_logged_in, sorted(principal.roles)])
+    redis_client.set(f'{REDIS_KEY_PRINCIPAL}:{principal.id}', value, ex=PRINCIPAL_CACHE_TTL_SECONDS)
+
+
+@reddis_exception()
+def delete_redis_principal(user_id: int):
+    redis_client.delete(f'{REDIS_KEY_PRINCIPAL}:{user_id}')
+
+
+if __name__ == "__main__":
+    pass
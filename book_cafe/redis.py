@@ -1,9 +1,136 @@
+import time
+from collections import Counter
+from threading import Lock
+
 from flask_redis import FlaskRedis
+from redis.exceptions import ConnectionError, RedisError, TimeoutError
+
+from book_cafe.app_logger import logger
+from book_cafe.exceptions import Redis_Circuit_Open
+from book_cafe.metrics import record_redis_call
+from configuration import REDIS_SOCKET_TIMEOUT_SECONDS, REDIS_CONNECT_TIMEOUT_SECONDS, REDIS_CIRCUIT_FAILURE_THRESHOLD, \
+    REDIS_CIRCUIT_RESET_SECONDS, NAVBAR_STREAM_BLOCK_MILLISECONDS
+
+CIRCUIT_STATES = ('closed', 'half_open', 'open')
+
+
+class Circuit_Breaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.counters = Counter()
+        self.lock = Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == 'closed': return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                self.counters['probes'] += 1
+                return True
+            self.counters['short_circuited'] += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state == 'closed': return
+            self.state = 'closed'
+            self.probing = False
+        logger.info("Redis circuit closed.")
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == 'open' or (self.state == 'closed' and self.failures < self.failure_threshold): return
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.counters['opened'] += 1
+        logger.warning(f"Redis circuit opened after {self.failures} failures.")
+
+    def call(self, function, *args, **kwargs):
+        if not self.allow():
+            raise Redis_Circuit_Open("Redis circuit open.")
+        try:
+            result = function(*args, **kwargs)
+        except (ConnectionError, TimeoutError):
+            self.record_failure()
+            raise
+        except RedisError:
+            self.record_success()
+            raise
+        finally:
+            self.release_probe()
+        self.record_success()
+        return result
+
+    def release_probe(self):
+        with self.lock:
+            self.probing = False
+
+    def metric_lines(self) -> list[str]:
+        with self.lock:
+            state, counters = self.state, dict(self.counters)
+        lines = ['# HELP bookcafe_redis_circuit_state Current state of the redis circuit breaker.',
+                 '# TYPE bookcafe_redis_circuit_state gauge']
+        lines += [f'bookcafe_redis_circuit_state{{state="{s}"}} {int(s == state)}' for s in CIRCUIT_STATES]
+        lines += ['# HELP bookcafe_redis_circuit_events_total Circuit breaker openings, probes and rejected calls.',
+                  '# TYPE bookcafe_redis_circuit_events_total counter']
+        lines += [f'bookcafe_redis_circuit_events_total{{event="{event}"}} {counters.get(event, 0)}'
+                  for event in ('opened', 'probes', 'short_circuited')]
+        return lines
+
+
+class Instrumented_Flask_Redis(FlaskRedis):
+    def init_app(self, app, **kwargs):
+        super().init_app(app, **kwargs)
+        instrument_client(self._redis_client)
+        blocking_kwargs = dict(self.provider_kwargs,
+                               socket_timeout=NAVBAR_STREAM_BLOCK_MILLISECONDS / 1000 + REDIS_SOCKET_TIMEOUT_SECONDS)
+        self.blocking_client = self.provider_class.from_url(app.config.get("REDIS_URL", "redis://localhost:6379/0"),
+                                                            **blocking_kwargs)
+        instrument_client(self.blocking_client)
+
+
+def instrument_client(client):
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def timed_execute_command(*args, **options):
+        started = time.perf_counter()
+        try:
+            return circuit_breaker.call(execute_command, *args, **options)
+        finally:
+            record_redis_call(str(args[0]).lower(), time.perf_counter() - started)
+
+    def instrumented_pipeline(*args, **kwargs):
+        new_pipeline = pipeline(*args, **kwargs)
+        execute = new_pipeline.execute
+
+        def timed_execute(*execute_args, **execute_kwargs):
+            started = time.perf_counter()
+            try:
+                return circuit_breaker.call(execute, *execute_args, **execute_kwargs)
+            finally:
+                record_redis_call('pipeline', time.perf_counter() - started)
+        new_pipeline.execute = timed_execute
+        return new_pipeline
+
+    client.execute_command = timed_execute_command
+    client.pipeline = instrumented_pipeline
 
-from configuration import REDIS_CONNECTION_STRING
 
-redis_client = FlaskRedis(host=REDIS_CONNECTION_STRING, decode_responses=True)
+circuit_breaker = Circuit_Breaker(REDIS_CIRCUIT_FAILURE_THRESHOLD, REDIS_CIRCUIT_RESET_SECONDS)
+redis_client = Instrumented_Flask_Redis(decode_responses=True, socket_timeout=REDIS_SOCKET_TIMEOUT_SECONDS,
+                                        socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECONDS)
 
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
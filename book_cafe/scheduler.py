@@ -0,0 +1,111 @@
+import os
+import random
+import socket
+import time
+from typing import Callable
+
+from flask import Flask
+from redis.exceptions import RedisError
+
+from book_cafe.app_logger import logger
+from book_cafe.exceptions import reddis_exception
+from book_cafe.redis import redis_client
+from configuration import BACKGROUND_JOB_JITTER_SECONDS, BACKGROUND_LEADER_LOCK_TTL_SECONDS, DEBUG_MODE_ON
+from constants import REDIS_KEY_BACKGROUND_LEADER, REDIS_KEY_BACKGROUND_JOB_METRICS
+
+RENEW_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end
+return 0
+"""
+
+
+class Leader_Lock:
+    def __init__(self, key: str, ttl_seconds: int):
+        self.key = key
+        self.ttl_milliseconds = ttl_seconds * 1000
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32)}'
+        self.is_leader = False
+
+    def acquire_or_renew(self) -> bool:
+        try:
+            if self.is_leader:
+                self.is_leader = bool(redis_client.eval(RENEW_LOCK_SCRIPT, 1, self.key, self.owner,
+                                                        self.ttl_milliseconds))
+            if not self.is_leader:
+                self.is_leader = bool(redis_client.set(self.key, self.owner, nx=True, px=self.ttl_milliseconds))
+        except RedisError:
+            logger.error("RedisError")
+            self.is_leader = False
+        return self.is_leader
+
+    @reddis_exception()
+    def release(self):
+        redis_client.eval(RELEASE_LOCK_SCRIPT, 1, self.key, self.owner)
+        self.is_leader = False
+
+
+class Job:
+    def __init__(self, name: str, function: Callable[[], int or None], interval_seconds: float,
+                 jitter_seconds: float = BACKGROUND_JOB_JITTER_SECONDS):
+        self.name = name
+        self.function = function
+        self.interval_seconds = interval_seconds
+        self.jitter_seconds = jitter_seconds
+        self.next_run = time.monotonic() + random.uniform(0, jitter_seconds)
+
+    def schedule_next_run(self):
+        self.next_run = time.monotonic() + self.interval_seconds + random.uniform(0, self.jitter_seconds)
+
+
+class Scheduler:
+    def __init__(self, app: Flask, jobs: list[Job]):
+        self.app = app
+        self.jobs = jobs
+        self.lock = Leader_Lock(REDIS_KEY_BACKGROUND_LEADER, BACKGROUND_LEADER_LOCK_TTL_SECONDS)
+        self.renew_interval_seconds = BACKGROUND_LEADER_LOCK_TTL_SECONDS / 3
+
+    def run_forever(self):
+        try:
+            while True:
+                self.run_pending()
+                next_run = min(j.next_run for j in self.jobs)
+                time.sleep(max(0.0, min(next_run - time.monotonic(), self.renew_interval_seconds)))
+        finally:
+            self.lock.release()
+
+    def run_pending(self):
+        if not self.lock.acquire_or_renew(): return
+        for job in self.jobs:
+            if job.next_run > time.monotonic(): continue
+            self.run_job(job)
+            job.schedule_next_run()
+            if not self.lock.acquire_or_renew(): return
+
+    def run_job(self, job: Job):
+        started = time.perf_counter()
+        with self.app.app_context():
+            rows = job.function()
+        duration_milliseconds = (time.perf_counter() - started) * 1000
+        record_job_metrics(job.name, duration_milliseconds, rows or 0)
+        if DEBUG_MODE_ON or rows:
+            logger.info(f"Job {job.name} processed {rows or 0} rows in {duration_milliseconds:.1f} ms.")
+
+
+@reddis_exception()
+def record_job_metrics(job_name: str, duration_milliseconds: float, rows: int):
+    key = f'{REDIS_KEY_BACKGROUND_JOB_METRICS}:{job_name}'
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.hset(key, mapping={'last_run': time.time(), 'last_duration_ms': round(duration_milliseconds, 3),
+                                'last_rows': rows})
+    pipeline.hincrby(key, 'runs_total', 1)
+    pipeline.hincrby(key, 'rows_total', rows)
+    pipeline.hincrbyfloat(key, 'duration_ms_total', round(duration_milliseconds, 3))
+    pipeline.execute()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,96 @@
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from hashlib import sha1
+from threading import Lock
+
+from book_cafe.exceptions import reddis_exception
+from book_cafe.redis import redis_client
+from configuration import SEARCH_CACHE_LRU_SIZE, SEARCH_CACHE_TTL_SECONDS
+from constants import REDIS_KEY_CATALOGUE_GENERATION, REDIS_KEY_CATALOGUE_MODIFIED, REDIS_KEY_SEARCH_CACHE
+
+
+class Search_Cache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.counters = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
+
+    def get(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counters['local_hits'] += 1
+                return self.entries[key]
+        value = get_redis_entry(key)
+        with self.lock:
+            if value is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['redis_hits'] += 1
+        self.set_local(key, value)
+        return value
+
+    def set(self, key: str, value):
+        self.set_local(key, value)
+        set_redis_entry(key, value)
+
+    def set_local(self, key: str, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters, local_size=len(self.entries), local_max_size=self.max_size)
+        lookups = stats['local_hits'] + stats['redis_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['local_hits'] + stats['redis_hits']) / lookups if lookups else 0.0
+        return stats
+
+
+search_cache = Search_Cache(max_size=SEARCH_CACHE_LRU_SIZE)
+
+
+def search_cache_key(generation: int, author: str, title: str, sort_by: str, cursor: str or None) -> str:
+    normalized = [(author or '').lower(), (title or '').lower(), sort_by, cursor]
+    digest = sha1(json.dumps(normalized).encode()).hexdigest()
+    return f'{REDIS_KEY_SEARCH_CACHE}:{generation}:{digest}'
+
+
+@reddis_exception()
+def get_redis_entry(key: str):
+    value = redis_client.get(key)
+    return json.loads(value) if value else None
+
+
+@reddis_exception()
+def set_redis_entry(key: str, value):
+    redis_client.set(key, json.dumps(value), ex=SEARCH_CACHE_TTL_SECONDS)
+
+
+@reddis_exception()
+def get_catalogue_generation() -> int:
+    return int(redis_client.get(REDIS_KEY_CATALOGUE_GENERATION) or 0)
+
+
+@reddis_exception()
+def get_catalogue_version() -> tuple[int, datetime or None]:
+    generation, modified = redis_client.mget(REDIS_KEY_CATALOGUE_GENERATION, REDIS_KEY_CATALOGUE_MODIFIED)
+    modified = datetime.fromtimestamp(int(modified), timezone.utc) if modified else None
+    return int(generation or 0), modified
+
+
+@reddis_exception()
+def bump_catalogue_generation():
+    pipeline = redis_client.pipeline()
+    pipeline.incr(REDIS_KEY_CATALOGUE_GENERATION)
+    pipeline.set(REDIS_KEY_CATALOGUE_MODIFIED, int(time.time()))
+    pipeline.execute()
+
+
+if __name__ == "__main__":
+    pass
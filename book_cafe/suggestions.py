@@ -0,0 +1,95 @@
+from typing import Iterable
+
+from book_cafe.exceptions import reddis_exception
+from book_cafe.redis import redis_client
+from configuration import SUGGEST_MAX_WORD_STARTS, SUGGEST_MAX_TERM_LENGTH
+from constants import REDIS_KEY_SUGGEST
+
+SUGGESTION_KINDS = ('title', 'author')
+TERM_SEPARATOR = '\x00'
+UPDATE_SUGGESTION_SCRIPT = """
+local count = redis.call('hincrby', KEYS[2], ARGV[1], ARGV[2])
+if count > 0 then
+    for i = 3, #ARGV do redis.call('zadd', KEYS[1], 0, ARGV[i]) end
+else
+    redis.call('hdel', KEYS[2], ARGV[1])
+    for i = 3, #ARGV do redis.call('zrem', KEYS[1], ARGV[i]) end
+end
+return count
+"""
+
+
+def index_key(kind: str) -> str:
+    return f'{REDIS_KEY_SUGGEST}:{kind}'
+
+
+def counts_key(kind: str) -> str:
+    return f'{REDIS_KEY_SUGGEST}:{kind}:counts'
+
+
+def normalize(text: str) -> str:
+    return ' '.join(text.lower().split())
+
+
+def suggestion_members(display: str) -> list[str]:
+    words = normalize(display).split(' ')
+    terms = {' '.join(words[i:])[:SUGGEST_MAX_TERM_LENGTH] for i in range(min(len(words), SUGGEST_MAX_WORD_STARTS))}
+    return [f'{term}{TERM_SEPARATOR}{display}' for term in terms if term]
+
+
+@reddis_exception()
+def update_suggestions(changes: list[tuple[str, str, int]]):
+    if not changes: return
+    pipeline = redis_client.pipeline(transaction=False)
+    for kind, display, delta in changes:
+        pipeline.eval(UPDATE_SUGGESTION_SCRIPT, 2, index_key(kind), counts_key(kind), display, delta,
+                      *suggestion_members(display))
+    pipeline.execute()
+
+
+@reddis_exception()
+def get_suggestions(prefix: str, limit: int) -> dict or None:
+    prefix = normalize(prefix).encode()
+    pipeline = redis_client.pipeline(transaction=False)
+    for kind in SUGGESTION_KINDS:
+        pipeline.zrangebylex(index_key(kind), b'[' + prefix, b'[' + prefix + b'\xff', start=0, num=limit * 3)
+    suggestions = dict()
+    for kind, members in zip(SUGGESTION_KINDS, pipeline.execute()):
+        displays = dict.fromkeys(m.split(TERM_SEPARATOR, 1)[1] for m in members)
+        suggestions[kind] = list(displays)[:limit]
+    return suggestions
+
+
+@reddis_exception()
+def rebuild_suggestions(kind: str, counts: Iterable[tuple[str, int]], chunk_size: int) -> int:
+    building_index, building_counts = f'{index_key(kind)}:rebuilding', f'{counts_key(kind)}:rebuilding'
+    redis_client.delete(building_index, building_counts)
+    rebuilt, chunk = 0, dict()
+    for display, count in counts:
+        if not display: continue
+        chunk[display] = count
+        if len(chunk) >= chunk_size:
+            store_suggestion_chunk(building_index, building_counts, chunk)
+            rebuilt, chunk = rebuilt + len(chunk), dict()
+    store_suggestion_chunk(building_index, building_counts, chunk)
+    rebuilt += len(chunk)
+    pipeline = redis_client.pipeline()
+    if rebuilt:
+        pipeline.rename(building_index, index_key(kind))
+        pipeline.rename(building_counts, counts_key(kind))
+    else:
+        pipeline.delete(index_key(kind), counts_key(kind))
+    pipeline.execute()
+    return rebuilt
+
+
+def store_suggestion_chunk(building_index: str, building_counts: str, chunk: dict):
+    if not chunk: return
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.zadd(building_index, {m: 0 for display in chunk for m in suggestion_members(display)})
+    pipeline.hset(building_counts, mapping=chunk)
+    pipeline.execute()
+
+
+if __name__ == "__main__":
+    pass
@@ -1,12 +1,13 @@
-from datetime import datetime
 from functools import wraps
 from typing import Callable
 
 from flask import redirect, url_for
 from flask_login import current_user, LoginManager
 
-from book_cafe.db_objects import db, User
+from book_cafe.activity_tracker import record_activity
+from book_cafe.db_objects import User
 from book_cafe.exceptions import sql_alchemy_exception
+from book_cafe.principal import Principal, get_cached_principal, cache_principal
 
 login_manager = LoginManager()
 login_manager.login_view = "login"
@@ -14,10 +15,14 @@ login_manager.login_view = "login"
 
 @login_manager.user_loader
 @sql_alchemy_exception()
-def load_user(user_id: int) -> User or None:
-    ret = User.get_user_by_id(user_id)
-    if not ret.is_logged_in: return None
-    return ret
+def load_user(user_id: int) -> Principal or None:
+    principal = get_cached_principal(int(user_id))
+    if not principal:
+        principal = User.get_principal(int(user_id))
+        if not principal: return None
+        cache_principal(principal)
+    if not principal.is_logged_in: return None
+    return principal
 
 
 @sql_alchemy_exception()
@@ -38,8 +43,7 @@ def refresh_user() -> Callable:
         @wraps(f)
         def wrapped(*args, **kwargs):
             if current_user and hasattr(current_user, 'username'):
-                current_user.last_activity = datetime.now()
-                db.session.commit()
+                record_activity(current_user.id)
             return f(*args, **kwargs)
         return wrapped
     return decorator
@@ -1,3 +1,20 @@
 DATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
 REDIS_KEY_NAVBAR_NEWS = 'navbar_news'
-REDIS_KEY_NAVBAR_NEWS_DATE = 'navbar_news_date'
\ No newline at end of file
+REDIS_KEY_NAVBAR_NEWS_DATE = 'navbar_news_date'
+REDIS_KEY_CATALOGUE_GENERATION = 'catalogue_generation'
+REDIS_KEY_CATALOGUE_MODIFIED = 'catalogue_modified'
+REDIS_KEY_SUGGEST = 'suggest'
+REDIS_KEY_SEARCH_CACHE = 'search_cache'
+REDIS_KEY_USER_ACTIVITY = 'user_activity'
+REDIS_KEY_USER_ACTIVITY_FLUSHED = 'user_activity_flushed'
+REDIS_KEY_PRINCIPAL = 'principal'
+REDIS_KEY_NAVBAR_NEWS_STREAM = 'navbar_news_stream'
+REDIS_KEY_BACKGROUND_LEADER = 'background_leader'
+REDIS_KEY_BACKGROUND_JOB_METRICS = 'background_job_metrics'
+REDIS_KEY_EMAIL_OUTBOX = 'email_outbox'
+REDIS_KEY_EMAIL_RETRY = 'email_outbox_retry'
+REDIS_KEY_EMAIL_DEAD = 'email_outbox_dead'
+REDIS_KEY_EMAIL_PROCESSING = 'email_outbox_processing'
+REDIS_KEY_LOGIN_FAILURES = 'login_failures'
+REDIS_KEY_CATALOGUE_FEED = 'catalogue_feed'
+REDIS_KEY_CATALOGUE_FEED_VERSION = 'catalogue_feed_version'